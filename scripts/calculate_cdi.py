@@ -72,9 +72,10 @@ def main():
     pool.close()
     pool.join()
 
-    # Combine the percentile ranked data into a CDI
+    # Combine the percentile ranked data into a CDI. The files are opened in parallel, with h5netcdf so that reads from
+    # different files don't wait on each other for the netCDF4 library.
     with xarray.open_mfdataset(ranked_files, chunks={'time': 10}, preprocess=standardise_dataset,
-                               combine='by_coords') as combined_dataset:
+                               combine='by_coords', parallel=True, engine='h5netcdf') as combined_dataset:
         calc_cdi(combined_dataset, options)
 
     # Remove temporary percentile ranked files
@@ -99,7 +100,11 @@ def percentile_rank_dataset(args):
             dataset = dataset.transpose('time', 'lat', 'lon')
         except ValueError:
             pass
-        utils.save_to_netcdf(dataset, output_path)
+        # percentile_rank() reads every twelfth time step, so each time step is stored as its own chunk
+        encoding = {}
+        if len(dataset[var].dims) == 3 and dataset[var].dims[0] == 'time':
+            encoding[var] = {'chunksizes': (1,) + dataset[var].shape[1:]}
+        utils.save_to_netcdf(dataset, output_path, encoding=encoding)
     percentile_rank(output_path, logging_level=verbosity, rank_vars=[var])
 
 
@@ -198,6 +203,12 @@ def get_options():
         required=False,
         default="all_but_one",
     )
+    parser.add_argument(
+        '--pack',
+        help='Save the CDI as 16 bit integers instead of 64 bit floats, which makes the file about a quarter of the '
+             'size. Values are then stored to within about 0.00002.',
+        action='store_true'
+    )
     args = parser.parse_args()
     return args
 
@@ -219,8 +230,13 @@ def calc_cdi(dataset: xarray.Dataset, options):
         with xarray.open_dataset(options.weights) as weights:
             weights = weights.sel(latitude=dataset.latitude, longitude=dataset.longitude, method='nearest',
                                   tolerance=0.01).reindex_like(dataset, method='nearest', tolerance=0.01)
-            dataset['cdi'] = dataset.groupby('time.month').apply(calc_cdi_for_month, args=(weights, options))
-            dataset = dataset.drop('month', errors='ignore')
+            # Look up each time step's weights by its month, so the whole CDI is one lazy expression rather than a
+            # groupby that splits the data by month
+            weights = weights.sel(month=dataset['time'].dt.month).drop('month')
+            dataset['cdi'] = dataset[options.ndvi_var] * weights.ndvi \
+                             + dataset[options.spi_var] * weights.spi \
+                             + (1 - dataset[options.et_var]) * weights.et \
+                             + dataset[options.sm_var] * weights.sm
     else:
         LOGGER.warning('--weights argument not provided. Substituting approximate values. If this is not your '
                        'intention, please provide a custom weights file.')
@@ -233,36 +249,23 @@ def calc_cdi(dataset: xarray.Dataset, options):
     for key in keys:
         if key != 'cdi':
             dataset = dataset.drop(key)
-    dataset = dataset.dropna('time', how='all')
-    # Percentile rank after finished.
-    attrs = {var: dataset[var].attrs for var in set(dataset.keys()).union(set(dataset.dims))}
-    stacked = dataset.cdi.stack(x=['latitude', 'longitude', 'time'])
-    stacked = stacked.compute()
-    stacked = stacked.rank(dim='x', pct=True, keep_attrs=False)
-    dataset['cdi'] = stacked.unstack(dim='x')
-    for key in attrs:
-        dataset[key].attrs = attrs[key]
+    # The CDI is computed once. Time steps with no data anywhere are found on the loaded array and dropped, rather than
+    # with dropna(), which would compute the whole CDI a second time.
+    cdi = dataset['cdi'].values
+    time_axis = dataset['cdi'].get_axis_num('time')
+    grid_axes = tuple(axis for axis in range(cdi.ndim) if axis != time_axis)
+    valid_times = numpy.flatnonzero(~numpy.isnan(cdi).all(axis=grid_axes))
+    dataset = dataset.isel(time=valid_times)
+    cdi = numpy.take(cdi, valid_times, axis=time_axis)
+    # Percentile rank after finished. Every grid cell and time is ranked together, straight on the loaded array, so the
+    # dataset keeps its shape and attributes.
+    ranks = bottleneck.nanrankdata(cdi, axis=None).reshape(cdi.shape)
+    dataset['cdi'] = dataset['cdi'].copy(data=ranks / numpy.count_nonzero(~numpy.isnan(cdi)))
     dataset['latitude'].attrs['units'] = 'degrees_north'
     dataset['longitude'].attrs['units'] = 'degrees_east'
-    utils.save_to_netcdf(dataset, options.output)
+    utils.save_to_netcdf(dataset, options.output, quantize={'cdi': None} if options.pack else None)
     return
 
 
-def calc_cdi_for_month(dataset: xarray.Dataset, weights, options):
-    """
-    Designed to be used with a groupby().apply() operation.
-    Calculates the CDI for one month of the year (January, February, etc.), since the weights applied to the input
-    datasets are different for each month.
-    """
-    month = dataset.time.values[0].astype('<M8[M]').item().month
-    weights = weights.sel(month=month)
-    dataset['cdi'] = dataset[options.ndvi_var] * weights.ndvi \
-                     + dataset[options.spi_var] * weights.spi \
-                     + (1 - dataset[options.et_var]) * weights.et \
-                     + dataset[options.sm_var] * weights.sm
-    dataset = dataset.drop('month', errors='ignore')
-    return dataset['cdi']
-
-
 if __name__ == '__main__':
     main()
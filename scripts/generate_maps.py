@@ -1,5 +1,5 @@
 import cartopy
-from shapely.ops import cascaded_union
+from shapely.ops import unary_union
 from cartopy.io import shapereader
 import os
 import argparse
@@ -7,17 +7,27 @@ import numpy
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import multiprocessing
+import multiprocessing.util
+from concurrent.futures import ThreadPoolExecutor
 import xarray
 import utils
 import logging
 import matplotlib
 from matplotlib.font_manager import FontProperties
-from matplotlib import pyplot
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.patches
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D, Bbox, ScaledTranslation
+from matplotlib.image import BboxImage
 import matplotlib.patheffects as PathEffects
 import warnings
 import rioxarray
-from descartes import PolygonPatch
+from descartes import PolygonPath
+import shapely.wkb
+import shutil
+import tempfile
+from PIL import Image
 
 logging.basicConfig(level=logging.WARN, format="%(asctime)s %(levelname)s: %(message)s", datefmt="%Y-%m-%d  %H:%M:%S")
 LOGGER = logging.getLogger(__name__)
@@ -30,6 +40,19 @@ OVERLAY_FONT = FontProperties(fname='fonts/Roboto-Medium.ttf', size=70)
 
 COLORBAR_LABELS_X_OFFSET = 1.3
 
+# Number of threads in each process that encode and save finished maps while the next map is drawn
+SAVE_THREADS = 2
+
+# About the number of pixels across a map. Grids finer than this are averaged down, since the detail can't be seen.
+MAX_GRID_SIZE = 1100
+
+# Runs with more maps than this will write the prepared data to a temporary Zarr store for the workers to read from
+ZARR_CONVERSION_THRESHOLD = 24
+
+# Settings and shapes shared by every map, filled in once per worker process by _pool_init()
+_MAP_SETTINGS = {}
+_SHAPE_CACHE = {}
+
 REGIONS = {
     'SEQ': {'Brisbane', 'Moreton Bay', 'Logan', 'Ipswich', 'Redland', 'Scenic Rim', 'Somerset', 'Lockyer Valley',
             'Gold Coast', 'Sunshine Coast', 'Toowoomba', 'Southern Downs'}
@@ -78,7 +101,7 @@ def get_options():
     required.add_argument(
         '--netcdf',
         required=True,
-        help='The path of the netCDF file containing the data.'
+        help='The path of the netCDF file containing the data. A Zarr store (ending in .zarr) can also be given.'
     )
     required.add_argument(
         '--var_name',
@@ -204,17 +227,18 @@ def get_options():
     optional.add_argument(
         '--no_downsampling',
         help='Don\'t downsample data to generate maps faster. This option can be helpful if downsampling is causing '
-             'blurred borders.',
+             'blurred borders, or for full resolution maps of very fine grids.',
         action='store_const',
         const=True,
         default=False
     )
     optional.add_argument(
         '--plot',
-        help='What method to use to plot the data. Options: pcolor, contour.',
+        help='What method to use to plot the data. Options: pcolor, contour, imshow. imshow is much faster than '
+             'contour for large grids, but requires a regular grid.',
         default='contour',
         type=str,
-        choices=['contour', 'pcolor']
+        choices=['contour', 'pcolor', 'imshow']
     )
     optional.add_argument(
         '--time_window',
@@ -251,30 +275,57 @@ def generate_all_maps(options, number_of_worker_processes):
     # Create folder for results
     os.makedirs(os.path.dirname(options.output_file_base), exist_ok=True)
 
-    # Open netCDF file
-    with xarray.open_dataset(options.netcdf) as dataset:
-        if 'time' in dataset.dims:
-            dataset = dataset.chunk({'time': 10})
+    # Work out which maps need to be generated from the time coordinate alone, so that nothing else is read or
+    # prepared when every map already exists
+    with open_data(options.netcdf) as dataset:
+        has_time = 'time' in dataset[options.var_name].dims
+        if has_time:
+            times = dataset['time'].values.astype('<M8[M]')
+
+    if has_time:
+        # Skip time slices that are not between the start_date and end_date
+        keep = numpy.ones(times.shape, dtype=bool)
+        if options.start_date:
+            keep &= times >= numpy.datetime64(options.start_date, 'M')
+        if options.end_date:
+            keep &= times <= numpy.datetime64(options.end_date, 'M')
+        # Names of the images for every time slice, e.g. 2020-01.jpg, made for all of them at once
+        file_names = numpy.char.add(numpy.datetime_as_string(times, unit='M'), '.jpg')
+        # Skip existing images if the user has not chosen to overwrite them. The output folder is listed once rather
+        # than checking whether each image exists one at a time.
+        if not options.overwrite:
+            output_dir = os.path.dirname(options.output_file_base) or '.'
+            existing_files = [entry.name for entry in os.scandir(output_dir)]
+            keep &= ~numpy.isin(numpy.char.add(os.path.basename(options.output_file_base), file_names), existing_files)
+        map_data = [(int(i), options.output_file_base + str(file_names[i]), times[i].item())
+                    for i in numpy.flatnonzero(keep)]
+
+        if len(map_data) == 0:
+            LOGGER.info('No maps to generate.')
+            return
+
+    # Read everything needed from the shapefile once, rather than once per map. The shapes are sent to the worker
+    # processes as WKB, which is much quicker to pickle than shapely geometries.
+    shapes = get_shapes(read_shape(options.shape), options.region)
+    area = shapes['area']
+    if len(area) == 0:
+        raise ValueError('That region does not exist in that shapefile.')
+    shapes_wkb = {
+        'area': [shapely.wkb.dumps(geometry) for geometry in area],
+        'labels': shapes['labels'],
+        'clip': shapely.wkb.dumps(shapes['clip']) if shapes['clip'] is not None else None
+    }
+
+    # Open netCDF file, and prepare it once here. The single process paths plot straight from this prepared dataset.
+    # With a pool, the data itself is only read by the worker processes, which open it for themselves and select their
+    # own time slices, so that the data doesn't have to be pickled and sent to them.
+    source = open_data(options.netcdf)
+    try:
+        dataset = prepare_dataset(source, options, area)
 
         # Get labels for latitude and longitude
         lon_label, lat_label = utils.get_lon_lat_names(dataset)
 
-        if options.region is None:
-            if not options.no_downsampling:
-                dataset = dataset.coarsen(dim={'time': 1, lat_label: 3, lon_label: 3}, boundary='pad').mean()
-        else:
-            shape = read_shape(options.shape)
-            if options.region in REGIONS:
-                regions = [record.geometry for record in shape.records() if record.attributes['NAME_2'] in REGIONS[options.region]]
-            else:
-                regions = [record.geometry for record in shape.records() if record.attributes['NAME_1'] == options.region]
-            if len(regions) == 0:
-                raise ValueError('That region does not exist in that shapefile.')
-            dataset = dataset.ffill(lon_label, limit=1).bfill(lon_label, limit=1)
-            dataset = dataset.ffill(lat_label, limit=1).bfill(lat_label, limit=1)
-            dataset.rio.write_crs('epsg:4326', inplace=True)
-            dataset = dataset.rio.clip(regions, all_touched=True)
-
         latitude = {
             'min': dataset[lat_label].min().item(),
             'mean': dataset[lat_label].mean().item(),
@@ -288,49 +339,121 @@ def generate_all_maps(options, number_of_worker_processes):
             'label': lon_label
         }
 
-        if 'time' not in dataset.dims:
-            generate_map((dataset, latitude, longitude, options, options.output_file_base + '.jpg', None))
+        if not has_time:
+            _pool_init(options, latitude, longitude, shapes_wkb, dataset=dataset)
+            generate_map((None, options.output_file_base + '.jpg', None))
+            finish_saves()
             return
 
-        start_date = datetime.strptime(options.start_date, '%Y-%m').date() if options.start_date else None
-        end_date = datetime.strptime(options.end_date, '%Y-%m').date() if options.end_date else None
-        map_data = []
-
-        for date, data_slice in dataset.groupby('time'):
-            date = date.astype('<M8[M]').item()
-
-            # Skip this image if it's not between the start_date and end_date
-            if (start_date and date < start_date) or (end_date and date > end_date):
-                continue
-
-            # Skip existing images if the user has not chosen to overwrite them.
-            file_path = '{}{}-{:02}.jpg'.format(options.output_file_base, date.year, date.month)
-            if not options.overwrite and os.path.exists(file_path):
-                continue
-
-            # Add to list of images to be generated
-            map_data.append((data_slice, latitude, longitude, options, file_path, date))
+        # Starting a pool isn't worth it for a single map or a single process
+        if number_of_worker_processes == 1 or len(map_data) == 1:
+            _pool_init(options, latitude, longitude, shapes_wkb, dataset=dataset)
+            for map_args in map_data:
+                generate_map(map_args)
+            finish_saves()
+            return
 
-    # Multiprocessing - one process per time slice
-    pool = multiprocessing.Pool(number_of_worker_processes)
-    pool.map(generate_map, map_data)
-    pool.close()
-    pool.join()
+        generate_maps_in_pool(options, number_of_worker_processes, map_data, source, dataset, latitude, longitude,
+                              shapes_wkb)
+    finally:
+        source.close()
 
 
-def generate_map(map_args):
-    # Unpack arguments
-    data, latitude, longitude, options, file_path, date = map_args
+def generate_maps_in_pool(options, number_of_worker_processes, map_data, source, dataset, latitude, longitude,
+                          shapes_wkb):
+    """
+    Generates maps with a pool of worker processes.
+
+    :param options: Command line options
+    :param number_of_worker_processes: Number of worker processes to start
+    :param map_data: List of arguments for generate_map(), one for each map
+    :param source: The dataset opened from options.netcdf, which is closed before the worker processes start
+    :param dataset: source after prepare_dataset()
+    :param latitude: Dictionary with the min, mean, max and label of the latitude dimension
+    :param longitude: Dictionary with the min, mean, max and label of the longitude dimension
+    :param shapes_wkb: Shapes from get_shapes(), with the geometries given as WKB
+    """
+    # For longer runs, write the prepared data to a temporary Zarr store with one chunk per map, so the downsampling or
+    # clipping is done once. Each worker can then read its own time slices straight from the store without repeating
+    # that work, and without the contention of many processes reading from the same HDF5 file.
+    # The store goes in its own temporary directory, rather than beside the input, which may be read-only or itself be
+    # a Zarr store.
+    data_path = options.netcdf
+    prepared = len(map_data) > ZARR_CONVERSION_THRESHOLD
+    temp_dir = tempfile.mkdtemp(suffix='.generate_maps') if prepared else None
+    try:
+        if prepared:
+            data_path = os.path.join(temp_dir, 'prepared.zarr')
+            LOGGER.info('Writing prepared data to ' + data_path)
+            dataset = dataset.isel(time=[time_index for time_index, _, _ in map_data])
+            dataset = dataset.chunk({'time': 1, latitude['label']: -1, longitude['label']: -1})
+            # Encoding carried over from the netCDF file doesn't apply to Zarr
+            for variable in dataset.variables.values():
+                variable.encoding = {}
+            dataset.to_zarr(data_path, mode='w')
+            map_data = [(time_index, file_path, date) for time_index, (_, file_path, date) in enumerate(map_data)]
+        # Closed before the worker processes are forked, so that they don't share this process's file handle
+        source.close()
+
+        # Multiprocessing - one process per time slice. Anything that is the same for every map is sent to each worker
+        # once through the initializer, instead of being pickled with every time slice.
+        pool = multiprocessing.Pool(number_of_worker_processes, initializer=_pool_init,
+                                    initargs=(options, latitude, longitude, shapes_wkb, data_path, prepared))
+        # Maps are sent in batches, and each batch waits for its own saves to finish before it's done
+        batch_size = max(1, len(map_data) // (number_of_worker_processes * 4))
+        batches = [map_data[i:i + batch_size] for i in range(0, len(map_data), batch_size)]
+        for _ in pool.imap_unordered(generate_map_batch, batches):
+            pass
+        pool.close()
+        pool.join()
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _pool_init(options, latitude, longitude, shapes_wkb, data_path=None, prepared=False, dataset=None):
+    """
+    Runs once in each worker process before any maps are generated.
+    Stores the settings and shapes used by every map, opens the dataset, and draws a character in each font on a hidden
+    canvas so that matplotlib's font cache is already populated when the first map is drawn.
+
+    :param options: Command line options
+    :param latitude: Dictionary with the min, mean, max and label of the latitude dimension
+    :param longitude: Dictionary with the min, mean, max and label of the longitude dimension
+    :param shapes_wkb: Shapes from get_shapes(), with the geometries given as WKB
+    :param data_path: Path of the data to plot
+    :param prepared: True if data_path is a Zarr store that has already been through prepare_dataset()
+    :param dataset: A dataset that has already been through prepare_dataset(), used instead of opening data_path
+    """
+    _MAP_SETTINGS['options'] = options
+    _MAP_SETTINGS['latitude'] = latitude
+    _MAP_SETTINGS['longitude'] = longitude
+    _SHAPE_CACHE['area'] = [shapely.wkb.loads(geometry) for geometry in shapes_wkb['area']]
+    _SHAPE_CACHE['labels'] = shapes_wkb['labels']
+    # The clipping outline is converted to a matplotlib path once here, rather than for every map
+    if shapes_wkb['clip'] is not None:
+        _SHAPE_CACHE['clip'] = PolygonPath(shapely.wkb.loads(shapes_wkb['clip']))
+    else:
+        _SHAPE_CACHE['clip'] = None
+    # The data is left open for the life of the process, and each map selects its time slice from it
+    if dataset is not None:
+        _MAP_SETTINGS['dataset'] = dataset
+    elif prepared:
+        _MAP_SETTINGS['dataset'] = xarray.open_zarr(data_path)
+    else:
+        _MAP_SETTINGS['dataset'] = prepare_dataset(open_data(data_path), options, _SHAPE_CACHE['area'])
+    _MAP_SETTINGS['lons'] = _MAP_SETTINGS['dataset'][longitude['label']].values
+    _MAP_SETTINGS['lats'] = _MAP_SETTINGS['dataset'][latitude['label']].values
+    # The projection and extent are the same for every map
     if options.region is None:
-        projection = cartopy.crs.LambertConformal(
+        _MAP_SETTINGS['projection'] = cartopy.crs.LambertConformal(
             central_longitude=longitude['mean'],
             central_latitude=latitude['mean'],
             standard_parallels=(-10, -40),
             cutoff=latitude['max']+2
         )
     else:
-        projection = cartopy.crs.PlateCarree()
-
+        _MAP_SETTINGS['projection'] = cartopy.crs.PlateCarree()
     if options.extent is not None:
         left, right, bottom, top = options.extent
     else:
@@ -338,61 +461,340 @@ def generate_map(map_args):
         right = longitude['max']
         bottom = latitude['min']
         top = latitude['max']
+    _MAP_SETTINGS['extent'] = (left, right, bottom, top+2)
+    # Contours are drawn straight in the map's projection. The grid is projected once here, rather than cartopy
+    # projecting every contour of every map as it's drawn.
+    if options.plot == 'contour':
+        lon_grid, lat_grid = numpy.meshgrid(_MAP_SETTINGS['lons'], _MAP_SETTINGS['lats'])
+        projected = _MAP_SETTINGS['projection'].transform_points(cartopy.crs.PlateCarree(), lon_grid, lat_grid)
+        _MAP_SETTINGS['contour_grid'] = (projected[..., 0], projected[..., 1])
+    # The levels and colour mapping are the same for every map
+    # Kept at the same precision as the data, so values on a boundary fall on the same side as they do in the file
+    if options.levels is not None and len(options.levels) > 1:
+        levels = numpy.asarray(options.levels, dtype='float32')
+    elif options.min is not None and options.max is not None and options.levels is not None:
+        levels = numpy.linspace(int(options.min), int(options.max), int(options.levels[0]), dtype='float32')
+    else:
+        levels = None
+    _MAP_SETTINGS['levels'] = levels
+    # Category labels are placed in the middle of each colour in the colourbar
+    if options.categories is not None:
+        if options.plot in ['contour', 'imshow']:
+            _MAP_SETTINGS['category_ticks'] = [(options.levels[i] + options.levels[i+1])/2
+                                               for i in range(0, len(options.levels)-1)]
+        else:
+            _MAP_SETTINGS['category_ticks'] = [x*0.85 + 0.5 for x in levels]
+        _MAP_SETTINGS['category_labels'] = options.categories.split(', ')
+    # With a fixed colour range the colourbar is the same on every map, so the area that each map covers can be reused.
+    # Contours and imshow are coloured by the levels, but pcolor only has a fixed range if both --min and --max are
+    # given. Otherwise the colourbar labels can change from map to map.
+    fixed_colours = levels is not None and (options.plot in ['contour', 'imshow'] or
+                                            (options.min is not None and options.max is not None))
+    _MAP_SETTINGS['bbox_cache'] = {} if fixed_colours else None
+    _MAP_SETTINGS['format_date'] = get_date_formatter(options.time_window, options.time_window_type)
+    # Without a list of colours, matplotlib's default colour map is used
+    if options.colours is not None:
+        _MAP_SETTINGS['cmap'] = matplotlib.colors.ListedColormap(options.colours)
+    else:
+        _MAP_SETTINGS['cmap'] = matplotlib.cm.get_cmap()
+    _MAP_SETTINGS['nodata_cmap'] = matplotlib.colors.ListedColormap(['#afafaf'])
+    if options.plot == 'imshow' and levels is not None:
+        _MAP_SETTINGS['norm'] = get_imshow_norm(levels, _MAP_SETTINGS['cmap'])
+    else:
+        _MAP_SETTINGS['norm'] = None
+    # Finished maps are saved in the background. Each batch of maps waits for its saves (generate_map_batch()), and
+    # worker processes also wait for them when they exit, in case anything is left.
+    _MAP_SETTINGS['save_executor'] = ThreadPoolExecutor(max_workers=SAVE_THREADS)
+    _MAP_SETTINGS['pending_saves'] = []
+    multiprocessing.util.Finalize(None, finish_saves, exitpriority=10)
+    # One figure is drawn on for every map in this process, and is cleared between maps
+    figure = Figure(figsize=(8, 8), dpi=150)  # Set size of the plot, at the resolution it will be saved
+    canvas = FigureCanvasAgg(figure)
+    for font in [TITLE_FONT, SUBTITLE_FONT, REGULAR_FONT, SMALL_FONT, OVERLAY_FONT]:
+        figure.text(0, 0, 'A', fontproperties=font)
+    canvas.draw()
+    # The grey background and the borders are the same on every map, so they are drawn once here. Each map then shows
+    # them as images instead of drawing every shape again.
+    area = _SHAPE_CACHE['area']
+    _MAP_SETTINGS['background'] = render_map_layer(
+        figure, _MAP_SETTINGS['projection'], _MAP_SETTINGS['extent'],
+        lambda ax: ax.add_geometries(area, cartopy.crs.PlateCarree(), edgecolor='none', facecolor='#afafaf',
+                                     linewidth=1)
+    )
+    _MAP_SETTINGS['borders'] = render_map_layer(
+        figure, _MAP_SETTINGS['projection'], _MAP_SETTINGS['extent'],
+        lambda ax: ax.add_geometries(area, cartopy.crs.PlateCarree(), edgecolor='black', facecolor='none',
+                                     linewidth=0.4)
+    )
+    # Text that is the same on every map is laid out once, and added to each map as a ready-made path
+    _MAP_SETTINGS['no_data_path'] = get_text_path('No data', SMALL_FONT, 'left')
+    _MAP_SETTINGS['prototype_path'] = get_text_path('PROTOTYPE', OVERLAY_FONT, 'center')
+    _MAP_SETTINGS['figure'] = figure
 
-    figure = pyplot.figure(figsize=(8, 8))  # Set size of the plot
-    ax = pyplot.axes(projection=projection, extent=(left, right, bottom, top+2))
-    pyplot.gca().outline_patch.set_visible(False)  # Remove border around plot
 
-    # Get the shape reader
-    shape = read_shape(options.shape)
+def get_imshow_norm(levels, cmap):
+    """
+    Gets the colour mapping for imshow that matches contourf with extend='both'. The first colour is for values below
+    the first level, the last colour for values above the last level, and the colours in between for each pair of
+    levels. This is why there should be one more colour than there are levels.
+
+    :param levels: Boundaries between the colours
+    :param cmap: Colour map with one more colour than there are levels
+    :return: matplotlib BoundaryNorm
+    """
+    return matplotlib.colors.BoundaryNorm(levels, cmap.N, extend='both')
+
+
+def get_date_formatter(time_window, time_window_type):
+    """
+    Gets a function that turns the date of a map into the text shown on it. Maps covering more than one month show the
+    range of months, with the date of the map being either the beginning or end of that range.
+
+    :param time_window: The number of months that each map is portraying
+    :param time_window_type: Whether the date of each map is the 'beginning' or 'end' of the time window
+    :return: Function taking a date and returning the date string
+    """
+    if time_window == 1:
+        return lambda date: date.strftime('%B %Y')
+    if time_window_type == 'beginning':
+        return lambda date: date.strftime('%B %Y') + ' - ' + \
+            (date + relativedelta(months=+(time_window - 1))).strftime('%B %Y')
+    return lambda date: (date + relativedelta(months=-(time_window - 1))).strftime('%B %Y') + ' - ' + \
+        date.strftime('%B %Y')
+
+
+def open_data(path):
+    """
+    Opens the data to be mapped, which can be either a netCDF file or a Zarr store.
+
+    :param path: Path of the netCDF file, or of the Zarr store if it ends in .zarr
+    :return: The opened dataset
+    """
+    if path.rstrip('/').endswith('.zarr'):
+        return xarray.open_zarr(path)
+    return xarray.open_dataset(path)
+
+
+def prepare_dataset(dataset, options, area):
+    """
+    Gets the dataset ready for plotting. Maps of the whole country are downsampled to make them faster to generate,
+    and maps of a region are clipped to that region. Regions are only downsampled if their grid is finer than the map.
+
+    :param dataset: Dataset opened from options.netcdf
+    :param options: Command line options
+    :param area: List of geometries making up the area being mapped
+    :return: The prepared dataset, containing only the variable being plotted. Nothing is loaded from disk.
+    """
+    # Single precision is plenty for plotting, and halves the memory used by everything after this point
+    dataset = dataset[[options.var_name]].astype('float32')
+    # Get labels for latitude and longitude
+    lon_label, lat_label = utils.get_lon_lat_names(dataset)
+
+    # Each map is one whole time slice, so each chunk is too
+    if 'time' in dataset.dims:
+        dataset = dataset.chunk({'time': 1, lat_label: -1, lon_label: -1})
 
-    # Draw grey background
     if options.region is None:
-        area = shape.geometries()
+        if not options.no_downsampling:
+            dataset = downsample(dataset, options.var_name, lat_label, lon_label,
+                                 max(3, get_downsampling_factor(dataset, lat_label, lon_label)))
     else:
-        if options.region in REGIONS:
-            area = [record.geometry for record in shape.records() if record.attributes['NAME_2'] in REGIONS[options.region]]
+        dataset = fill_edges(dataset, options.var_name, lat_label, lon_label)
+        dataset.rio.write_crs('epsg:4326', inplace=True)
+        dataset = dataset.rio.clip(area, all_touched=True)
+        # Regions are usually small enough to map at full resolution, which keeps their borders sharp
+        factor = get_downsampling_factor(dataset, lat_label, lon_label)
+        if factor > 1 and not options.no_downsampling:
+            dataset = downsample(dataset, options.var_name, lat_label, lon_label, factor)
+    # The coordinates are cast last, because the clip above works out the grid's transform from them
+    dataset = dataset.assign_coords({
+        lon_label: dataset[lon_label].astype('float32'),
+        lat_label: dataset[lat_label].astype('float32')
+    })
+    return dataset
+
+
+def get_downsampling_factor(dataset, lat_label, lon_label):
+    """
+    Works out how much a grid can be downsampled before it becomes coarser than the map it's drawn on.
+
+    :param dataset: Dataset containing the grid
+    :param lat_label: Name of the latitude dimension
+    :param lon_label: Name of the longitude dimension
+    :return: The largest factor that keeps the grid at least MAX_GRID_SIZE cells across, or 1 if it already isn't
+    """
+    return max(1, max(dataset.sizes[lat_label], dataset.sizes[lon_label]) // MAX_GRID_SIZE)
+
+
+def downsample(dataset, var_name, lat_label, lon_label, factor):
+    """
+    Downsamples a variable by averaging each block of factor x factor grid cells, the same as
+    coarsen(boundary='pad').mean(). Works on each time chunk as a plain NumPy array rather than through xarray's
+    rolling window machinery.
+
+    :param dataset: Dataset containing the variable
+    :param var_name: Name of the variable to downsample
+    :param lat_label: Name of the latitude dimension
+    :param lon_label: Name of the longitude dimension
+    :param factor: Number of grid cells along each side of a block
+    :return: Dataset containing only the downsampled variable
+    """
+    new_sizes = {label: -(-dataset.sizes[label] // factor) for label in [lat_label, lon_label]}
+    data = xarray.apply_ufunc(
+        _block_mean, dataset[var_name],
+        input_core_dims=[[lat_label, lon_label]],
+        output_core_dims=[[lat_label, lon_label]],
+        exclude_dims={lat_label, lon_label},
+        kwargs={'factor': factor, 'ndim': 2},
+        dask='parallelized',
+        output_dtypes=[dataset[var_name].dtype],
+        dask_gufunc_kwargs={'output_sizes': new_sizes},
+        keep_attrs=True
+    )
+    data = data.assign_coords({
+        lat_label: _block_mean(dataset[lat_label].values, factor, 1),
+        lon_label: _block_mean(dataset[lon_label].values, factor, 1)
+    })
+    for label in [lat_label, lon_label]:
+        data[label].attrs = dataset[label].attrs
+    return data.to_dataset(name=var_name)
+
+
+def _block_mean(array, factor, ndim):
+    """
+    Averages blocks of factor cells along each of the last ndim axes of a NumPy array, ignoring NaNs. Edges are padded
+    with NaN so they still form a full block.
+    """
+    leading_shape = array.shape[:array.ndim - ndim]
+    padding = [(0, 0)] * len(leading_shape)
+    blocks_shape = list(leading_shape)
+    for size in array.shape[array.ndim - ndim:]:
+        num_blocks = -(-size // factor)
+        padding.append((0, num_blocks * factor - size))
+        blocks_shape += [num_blocks, factor]
+    blocks = numpy.pad(array, padding, constant_values=numpy.nan).reshape(blocks_shape)
+    # Blocks that are entirely NaN are expected, and their mean is NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return numpy.nanmean(blocks, axis=tuple(range(len(leading_shape) + 1, len(blocks_shape), 2)))
+
+
+def fill_edges(dataset, var_name, lat_label, lon_label):
+    """
+    Extends the data by one grid cell into any missing cells, first along longitude and then along latitude, so that
+    the clipped map reaches the coastline. Gives the same result as ffill(limit=1).bfill(limit=1) along each dimension,
+    but in a single pass over each time chunk.
+
+    :param dataset: Dataset containing the variable
+    :param var_name: Name of the variable to fill
+    :param lat_label: Name of the latitude dimension
+    :param lon_label: Name of the longitude dimension
+    :return: Dataset containing only the filled variable
+    """
+    data = xarray.apply_ufunc(
+        _fill_edges, dataset[var_name],
+        input_core_dims=[[lat_label, lon_label]],
+        output_core_dims=[[lat_label, lon_label]],
+        dask='parallelized',
+        output_dtypes=[dataset[var_name].dtype],
+        keep_attrs=True
+    )
+    return data.to_dataset(name=var_name)
+
+
+def _fill_edges(array):
+    """
+    Fills missing cells that are next to a valid cell along the last axis, then the second last axis of a NumPy array.
+    The cell before is preferred over the cell after, as a forward fill followed by a backward fill would do.
+    """
+    array = array.copy()
+    for axis in [-1, -2]:
+        missing = numpy.isnan(array)
+        before = numpy.full_like(array, numpy.nan)
+        after = numpy.full_like(array, numpy.nan)
+        if axis == -1:
+            before[..., 1:] = array[..., :-1]
+            after[..., :-1] = array[..., 1:]
         else:
-            area = [record.geometry for record in shape.records() if record.attributes['NAME_1'] == options.region]
-    ax.add_geometries(area, cartopy.crs.PlateCarree(), edgecolor='none', facecolor='#afafaf', linewidth=1, zorder=0)
+            before[..., 1:, :] = array[..., :-1, :]
+            after[..., :-1, :] = array[..., 1:, :]
+        fill = numpy.where(numpy.isnan(before), after, before)
+        array[missing] = fill[missing]
+    return array
+
+
+def generate_map_batch(batch):
+    """
+    Generates a batch of maps in a worker process, then waits for their JPEGs to be saved. Any error saving them is
+    then raised in the main process, rather than lost when the worker exits.
+
+    :param batch: List of arguments for generate_map()
+    """
+    for map_args in batch:
+        generate_map(map_args)
+    wait_for_saves()
+
+
+def generate_map(map_args):
+    # Unpack arguments
+    time_index, file_path, date = map_args
+    options = _MAP_SETTINGS['options']
+    latitude = _MAP_SETTINGS['latitude']
+    longitude = _MAP_SETTINGS['longitude']
+    data = _MAP_SETTINGS['dataset'][options.var_name]
+    if time_index is not None:
+        data = data.isel(time=time_index)
+    # Read this map's data into a plain NumPy array, with latitude along the first axis, so that matplotlib doesn't have
+    # to go through xarray
+    values = data.transpose(latitude['label'], longitude['label']).values
+    lons = _MAP_SETTINGS['lons']
+    lats = _MAP_SETTINGS['lats']
+    figure = _MAP_SETTINGS['figure']
+    figure.clear()  # Remove everything drawn for the previous map
+    ax = figure.add_subplot(1, 1, 1, projection=_MAP_SETTINGS['projection'], extent=_MAP_SETTINGS['extent'])
+    ax.outline_patch.set_visible(False)  # Remove border around plot
+
+    # Draw grey background
+    add_map_layer(ax, _MAP_SETTINGS['background'], zorder=0)
 
     # Plot the data
-    if options.levels is not None and len(options.levels) > 1:
-        levels = options.levels
-    elif options.min is not None and options.max is not None and options.levels is not None:
-        levels = numpy.linspace(int(options.min), int(options.max), int(options.levels[0]))
-    else:
-        levels = None
+    levels = _MAP_SETTINGS['levels']
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', category=RuntimeWarning)
         if options.plot == 'contour':
-            im = ax.contourf(data[longitude['label']], data[latitude['label']], data[options.var_name], extend='both',
-                             transform=cartopy.crs.PlateCarree(), colors=options.colours, levels=levels, zorder=1)
+            x, y = _MAP_SETTINGS['contour_grid']
+            im = ax.contourf(x, y, values, extend='both', transform=ax.transData, colors=options.colours,
+                             levels=levels, zorder=1)
             # On smaller maps, bleeding over borders is visible due to a coarse resolution. This code masks the plot at
             # the border but it's not necessary on larger maps.
             if options.region is not None:
-                mask = PolygonPatch(cascaded_union(area), transform=ax.transData)
+                mask = matplotlib.patches.PathPatch(_SHAPE_CACHE['clip'], transform=ax.transData)
                 for c in im.collections:
+                    c.set_rasterized(True)
                     c.set_clip_path(mask)
+        elif options.plot == 'imshow':
+            # imshow draws the grid as a single image, so the cell edges are worked out from the coordinates
+            if lats[0] > lats[-1]:
+                lats = lats[::-1]
+                values = values[::-1]
+            half_lon = (lons[-1] - lons[0]) / (len(lons) - 1) / 2 if len(lons) > 1 else 0.5
+            half_lat = (lats[-1] - lats[0]) / (len(lats) - 1) / 2 if len(lats) > 1 else 0.5
+            im = ax.imshow(values, origin='lower', interpolation='nearest', cmap=_MAP_SETTINGS['cmap'],
+                           norm=_MAP_SETTINGS['norm'],
+                           extent=(lons[0] - half_lon, lons[-1] + half_lon, lats[0] - half_lat, lats[-1] + half_lat),
+                           transform=cartopy.crs.PlateCarree(), zorder=1)
         else:
-            cmap = matplotlib.colors.ListedColormap(options.colours)
-            im = ax.pcolormesh(data[longitude['label']], data[latitude['label']], data[options.var_name], cmap=cmap,
-                               transform=cartopy.crs.PlateCarree(), zorder=1)
-
-    # Draw borders
-    for state in shape.records():
-        if options.region is None or state.attributes['NAME_1'] == options.region:
-            ax.add_geometries([state.geometry], cartopy.crs.PlateCarree(), edgecolor='black', facecolor='none',
-                              linewidth=0.4, zorder=3)
-    if options.region in REGIONS:
-        ax.add_geometries(area, cartopy.crs.PlateCarree(), edgecolor='black', facecolor='none',
-                          linewidth=0.4, zorder=3)
-        for record in shape.records():
-            if record.attributes['NAME_2'] in REGIONS[options.region]:
-                region_label = ax.text(record.geometry.centroid.x, record.geometry.centroid.y, record.attributes['NAME_2'], fontproperties=TITLE_FONT, ha='center',
-                                       va='center', transform=cartopy.crs.PlateCarree(), color='white', size=10)
-                region_label.set_path_effects([PathEffects.withStroke(linewidth=1, foreground='black')])
-                region_label.set_zorder(5)
+            # The coordinates are cell centres, so 'auto' shading centres each cell on them
+            im = ax.pcolormesh(lons, lats, values, cmap=_MAP_SETTINGS['cmap'], vmin=options.min, vmax=options.max,
+                               shading='auto', transform=cartopy.crs.PlateCarree(), zorder=1)
+
+    # Draw borders (these are the outlines of the same shapes as the grey background)
+    add_map_layer(ax, _MAP_SETTINGS['borders'], zorder=3)
+    for x, y, name in _SHAPE_CACHE['labels']:
+        region_label = ax.text(x, y, name, fontproperties=TITLE_FONT, ha='center', va='center',
+                               transform=cartopy.crs.PlateCarree(), color='white', size=10)
+        region_label.set_path_effects([PathEffects.withStroke(linewidth=1, foreground='black')])
+        region_label.set_zorder(5)
 
     # Add a colourbar
     colourbar_axis = figure.add_axes([options.colourbar_position[0], options.colourbar_position[1] + 0.03,
@@ -400,11 +802,8 @@ def generate_map(map_args):
     colourbar = figure.colorbar(im, cax=colourbar_axis, extendfrac=0)
     if options.categories is not None:
         colourbar.ax.tick_params(axis='both', which='both', length=0)
-        if options.plot == 'contour':
-            colourbar.set_ticks([(options.levels[i] + options.levels[i+1])/2 for i in range(0, len(options.levels)-1)])
-        else:
-            colourbar.set_ticks([x*0.85 + 0.5 for x in levels])
-        colourbar.set_ticklabels(options.categories.split(', '))
+        colourbar.set_ticks(_MAP_SETTINGS['category_ticks'])
+        colourbar.set_ticklabels(_MAP_SETTINGS['category_labels'])
     for tick in colourbar_axis.get_yticklabels():
         tick.set_font_properties(SMALL_FONT)
 
@@ -412,42 +811,192 @@ def generate_map(map_args):
     if options.no_data:
         nodata_axis = figure.add_axes([options.colourbar_position[0], options.colourbar_position[1], .019,
                                        .016])
-        nodata_cmap = matplotlib.colors.ListedColormap(['#afafaf'])
-        matplotlib.colorbar.ColorbarBase(nodata_axis, cmap=nodata_cmap, extend='neither')
+        matplotlib.colorbar.ColorbarBase(nodata_axis, cmap=_MAP_SETTINGS['nodata_cmap'], extend='neither')
         nodata_axis.get_yaxis().set_ticks([])
-        nodata_axis.text(1.3, .4, 'No data', ha='left', va='center', fontproperties=SMALL_FONT)
+        add_text_path(figure, _MAP_SETTINGS['no_data_path'], COLORBAR_LABELS_X_OFFSET, .4, nodata_axis.transAxes)
 
     # Add date of this map, and title/subtitle/index name if given
     if date is not None:
-        if options.time_window is not 1:
-            if options.time_window_type == 'beginning':
-                date2 = date + relativedelta(months=+(options.time_window - 1))
-                date_str = date.strftime('%B %Y') + ' - ' + date2.strftime('%B %Y')
-            else:
-                date2 = date + relativedelta(months=-(options.time_window - 1))
-                date_str = date2.strftime('%B %Y') + ' - ' + date.strftime('%B %Y')
-        else:
-            date_str = date.strftime('%B %Y')
-        pyplot.text(options.label_position[0], options.label_position[1], date_str, transform=ax.transAxes,
+        date_str = _MAP_SETTINGS['format_date'](date)
+        figure.text(options.label_position[0], options.label_position[1], date_str, transform=ax.transAxes,
                     fontproperties=REGULAR_FONT)
     label_space = .04 if options.region in REGIONS else .05
     if options.title:
-        pyplot.text(options.label_position[0], options.label_position[1] + label_space, options.title,
+        figure.text(options.label_position[0], options.label_position[1] + label_space, options.title,
                     transform=ax.transAxes, fontproperties=TITLE_FONT)
     if options.subtitle:
-        pyplot.text(options.label_position[0], options.label_position[1] + label_space*2, options.subtitle,
+        figure.text(options.label_position[0], options.label_position[1] + label_space*2, options.subtitle,
                     transform=ax.transAxes, fontproperties=SUBTITLE_FONT)
     if options.colourbar_label:
         colourbar_axis.set_title(options.colourbar_label, fontproperties=REGULAR_FONT)
 
     # Add prototype overlay if requested
     if options.prototype:
-        pyplot.text(.55, .4, "PROTOTYPE", transform=ax.transAxes, alpha=.15, fontproperties=OVERLAY_FONT,
-                    horizontalalignment='center', verticalalignment='center')
+        add_text_path(figure, _MAP_SETTINGS['prototype_path'], .55, .4, ax.transAxes, alpha=.15)
+
+    # Save map. Only a few saves are allowed to queue up, so that finished images don't pile up in memory.
+    pending_saves = _MAP_SETTINGS['pending_saves']
+    while len(pending_saves) >= SAVE_THREADS:
+        pending_saves.pop(0).result()
+    save = save_jpeg(figure, file_path, _MAP_SETTINGS['save_executor'], _MAP_SETTINGS['bbox_cache'])
+    if save is not None:
+        pending_saves.append(save)
 
-    # Save map
-    pyplot.savefig(file_path, dpi=150, bbox_inches='tight', quality=80)
-    pyplot.close()
+
+def render_map_layer(figure, projection, extent, draw):
+    """
+    Draws something that is the same on every map by itself, on a transparent background, and returns it as an image
+    that can be shown with add_map_layer(). The figure is left cleared.
+
+    :param figure: Figure with an Agg canvas, the same size and resolution as the maps
+    :param projection: Projection of the maps
+    :param extent: Extent of the maps
+    :param draw: Function that draws the layer, given the map's axes
+    :return: RGBA image of the map's axes as a NumPy array
+    """
+    figure.clear()
+    figure.patch.set_visible(False)
+    ax = figure.add_subplot(1, 1, 1, projection=projection, extent=extent)
+    ax.outline_patch.set_visible(False)
+    ax.background_patch.set_visible(False)
+    draw(ax)
+    figure.canvas.draw()
+    x0, y0, x1, y1 = numpy.round(ax.bbox.extents).astype(int)
+    height = int(round(figure.bbox.height))
+    image = numpy.asarray(figure.canvas.buffer_rgba())[height - y1:height - y0, x0:x1].copy()
+    figure.clear()
+    figure.patch.set_visible(True)
+    return image
+
+
+def add_map_layer(ax, image, zorder):
+    """
+    Shows an image from render_map_layer() over the whole of the map's axes.
+
+    :param ax: The map's axes
+    :param image: Image from render_map_layer()
+    :param zorder: Where the layer is drawn relative to everything else on the map
+    """
+    layer = BboxImage(ax.bbox, interpolation='nearest', zorder=zorder)
+    layer.set_data(image)
+    ax.add_artist(layer)
+
+
+def get_text_path(text, font, horizontal_alignment):
+    """
+    Lays out a line of text as a path, so that it can be drawn on many maps without being laid out each time.
+
+    :param text: The text
+    :param font: FontProperties to draw the text with
+    :param horizontal_alignment: 'left' or 'center'. The text is always centred vertically.
+    :return: Path in points, with its origin at the point the text is aligned to
+    """
+    path = TextPath((0, 0), text, prop=font)
+    extents = path.get_extents()
+    x_offset = (extents.x0 + extents.x1) / 2 if horizontal_alignment == 'center' else 0
+    return Affine2D().translate(-x_offset, -(extents.y0 + extents.y1) / 2).transform_path(path)
+
+
+def add_text_path(figure, path, x, y, transform, **kwargs):
+    """
+    Draws a path from get_text_path() on the figure.
+
+    :param figure: Figure to draw on
+    :param path: Path from get_text_path()
+    :param x: x position to align the text to
+    :param y: y position to align the text to
+    :param transform: Transform that x and y are given in, e.g. ax.transAxes
+    :param kwargs: Any other arguments for PathPatch, such as alpha
+    """
+    path_transform = Affine2D().scale(1 / 72) + figure.dpi_scale_trans + ScaledTranslation(x, y, transform)
+    figure.add_artist(matplotlib.patches.PathPatch(path, transform=path_transform, facecolor='black',
+                                                   edgecolor='none', **kwargs))
+
+
+def save_jpeg(figure, file_path, executor=None, bbox_cache=None):
+    """
+    Saves the figure as a JPEG, cropped to the area that has been drawn on. This gives the same result as
+    savefig(bbox_inches='tight') but only draws the figure once, and the JPEG is encoded by Pillow straight from the
+    canvas.
+
+    :param figure: Figure with an Agg canvas, at the resolution it will be saved
+    :param file_path: Path to save the image to
+    :param executor: If given, the image is encoded and saved on this executor instead of before returning
+    :param bbox_cache: If given, the area drawn on by the first figure is kept in this dictionary and reused for later
+        figures, and only the figure's text is measured again. Only use this when everything else is laid out the same
+        on every figure.
+    :return: Future for the save if an executor was given and used, otherwise None
+    """
+    canvas = figure.canvas
+    canvas.draw()
+    width, height = figure.get_size_inches()
+    renderer = canvas.get_renderer()
+    if bbox_cache is None or 'bbox' not in bbox_cache:
+        bbox = figure.get_tightbbox(renderer)
+        if bbox_cache is not None:
+            bbox_cache['bbox'] = bbox
+    else:
+        # Only the text, such as the date, changes in size from one map to the next
+        text_bboxes = [text.get_window_extent(renderer).transformed(figure.dpi_scale_trans.inverted())
+                       for text in figure.texts]
+        bbox = Bbox.union([bbox_cache['bbox']] + text_bboxes)
+    bbox = bbox.padded(0.1)
+    # If anything has been drawn outside the figure, it can't be cropped from the canvas so fall back to savefig
+    if bbox.x0 < 0 or bbox.y0 < 0 or bbox.x1 > width or bbox.y1 > height:
+        figure.savefig(file_path, dpi=figure.dpi, bbox_inches='tight', quality=80)
+        return None
+    left = int(bbox.x0 * figure.dpi)
+    right = int(numpy.ceil(bbox.x1 * figure.dpi))
+    top = int((height - bbox.y1) * figure.dpi)
+    bottom = int(numpy.ceil((height - bbox.y0) * figure.dpi))
+    # Copied so that the canvas can be drawn on again while the image is being saved
+    image = Image.fromarray(numpy.asarray(canvas.buffer_rgba())[top:bottom, left:right, :3].copy())
+    if executor is None:
+        image.save(file_path, 'JPEG', quality=80)
+        return None
+    return executor.submit(image.save, file_path, 'JPEG', quality=80)
+
+
+def wait_for_saves():
+    """
+    Waits for any maps still being saved in the background by this process, raising any error from saving them.
+    """
+    pending_saves = _MAP_SETTINGS.get('pending_saves', [])
+    while pending_saves:
+        pending_saves.pop(0).result()
+
+
+def finish_saves():
+    """
+    Waits for any maps still being saved in the background by this process, then stops the threads saving them.
+    """
+    wait_for_saves()
+    if 'save_executor' in _MAP_SETTINGS:
+        _MAP_SETTINGS['save_executor'].shutdown()
+
+
+def get_shapes(shape, region=None):
+    """
+    Picks out everything needed from the shapefile to draw the maps, so that it only needs to be read once.
+
+    :param shape: Shapefile reader
+    :param region: Name of a state, or one of the custom REGIONS. If None, the whole shapefile is used.
+    :return: Dictionary containing:
+             area - list of geometries making up the area to be mapped. Also used for the borders.
+             labels - list of (longitude, latitude, name) tuples for labelling the parts of a custom region
+             clip - the union of the area, used to mask the plot at its border. None if region is None.
+    """
+    if region is None:
+        return {'area': list(shape.geometries()), 'labels': [], 'clip': None}
+    if region in REGIONS:
+        records = [record for record in shape.records() if record.attributes['NAME_2'] in REGIONS[region]]
+        labels = [(record.geometry.centroid.x, record.geometry.centroid.y, record.attributes['NAME_2'])
+                  for record in records]
+    else:
+        records = [record for record in shape.records() if record.attributes['NAME_1'] == region]
+        labels = []
+    area = [record.geometry for record in records]
+    return {'area': area, 'labels': labels, 'clip': unary_union(area) if area else None}
 
 
 def read_shape(shapefile=None):
@@ -1,11 +1,12 @@
 import argparse
 import netCDF4
 from datetime import datetime
-import scipy.stats
+import bottleneck
 import logging
 import numpy
 import utils
 import shutil
+import os
 logging.basicConfig(level=logging.WARN, format="%(asctime)s %(levelname)s: %(message)s", datefmt="%Y-%m-%d  %H:%M:%S")
 LOGGER = logging.getLogger(__name__)
 
@@ -27,7 +28,8 @@ def main():
     LOGGER.setLevel(options.verbose)
     start_time = datetime.now()
     LOGGER.info('Starting time: ' + str(start_time))
-    if options.output and options.output is not options.input:
+    # The ranks are written in place, so the input is only copied if the result should go somewhere else
+    if options.output and os.path.abspath(options.output) != os.path.abspath(options.input):
         shutil.copyfile(options.input, options.output)
     else:
         options.output = options.input
@@ -83,45 +85,50 @@ def percentile_rank(file_path, rank_vars=None, logging_level=logging.WARN):
     LOGGER.setLevel(logging_level)
     dataset = netCDF4.Dataset(file_path, mode='a')
     lon, lat = utils.get_lon_lat_names(dataset)
-    num_months = len(dataset.dimensions['time'])
-    num_rows = len(dataset.dimensions[lat])
-    num_columns = len(dataset.dimensions[lon])
-    et_dates = numpy.array(dataset.variables['time'])[:]
+    # Group the time steps by calendar month using the time coordinate, so the data doesn't need to start in January
+    times = dataset.variables['time']
+    dates = netCDF4.num2date(times[:], times.units, getattr(times, 'calendar', 'standard'))
+    month_index = numpy.array([date.month for date in dates]) - 1
+    if rank_vars is None:
+        rank_vars = [name for name, variable in dataset.variables.items()
+                     if set(variable.dimensions) == {'time', lat, lon}]
+    if len(rank_vars) == 0:
+        dataset.close()
+        raise NoDataException('No variables to percentile rank in ' + file_path)
+    for var in rank_vars:
+        if dataset.variables[var].dimensions != ('time', lat, lon):
+            dataset.close()
+            raise ValueError('Dimensions must be in order: time, latitude, longitude. Try using utils/transpose.py')
+        # Ranks are written in place, so they would be rounded to the precision of a variable packed into integers
+        if hasattr(dataset.variables[var], 'scale_factor') or hasattr(dataset.variables[var], 'add_offset'):
+            dataset.close()
+            raise ValueError(var + ' is packed into integers, which would round the percentile ranks. Save an unpacked '
+                             'copy first, e.g. with utils/truncate_time_dim.py')
 
     for month_of_year in range(0, 12):
-        month = month_of_year  # set i equal to m for counting
-        num_years = int(num_months / 12)  # find number of years in the dataset
-        if month_of_year < num_months % 12:
-            num_years = num_years + 1
-        month_et = numpy.full([num_years, num_rows, num_columns], numpy.nan)
-        date_list = []
-        i_list = []
-
-        for year in range(0, num_years):
-            try:
-                month_et[year, :, :] = dataset.variables[rank_vars[0]][month, :, :]
-            except ValueError:
-                raise ValueError('Dimensions must be in order: time, latitude, longitude. Try using utils/transpose.py')
-            date_list.append(et_dates[month])
-            i_list.append(month)
-            month = month + 12
-
-        m_month_et = numpy.ma.masked_invalid(month_et)
-        r_month_et = numpy.empty(m_month_et.shape)
-        for row in range(0, num_rows):
-            for column in range(0, num_columns):
-                if m_month_et[:, row, column].count() == 0:
-                    r_month_et[:, row, column] = 0
-                else:
-                    r_month_et[:, row, column] = scipy.stats.mstats.rankdata(m_month_et[:, row, column],
-                                                                             use_missing=False)
-        m_r_month_et = numpy.ma.array(r_month_et, mask=m_month_et.mask)
-        pr_month_et = (m_r_month_et - 1) / m_r_month_et.count(axis=0)
-        m_pr_month_et = numpy.ma.array(pr_month_et, mask=m_month_et.mask)
-
-        for ix, ixf in enumerate(i_list):
-            dataset['time'][ixf] = date_list[ix]
-            dataset[rank_vars[0]][ixf] = m_pr_month_et[ix]
+        i_list = numpy.flatnonzero(month_index == month_of_year)
+        if len(i_list) == 0:
+            continue
+        for var in rank_vars:
+            LOGGER.info('Ranking ' + var + ' for month ' + str(month_of_year + 1))
+            # Every year of this month is read in one call. Single precision is plenty for ranking, and halves the
+            # memory the ranking works through.
+            month_et = numpy.ma.filled(dataset.variables[var][i_list, :, :].astype('float32'), numpy.nan)
+
+            # Rank every grid cell at once along the years axis. Missing values are left out of the ranking, and cells
+            # with no values at all (such as the ocean) aren't ranked. Ranks are turned into percentiles with the Hazen
+            # formula, (rank - 0.5) / count, so the lowest and highest values sit the same distance from 0 and 1.
+            invalid = ~numpy.isfinite(month_et)
+            month_et[invalid] = numpy.nan
+            valid_cells = ~invalid.all(axis=0)
+            pr_month_et = numpy.full(month_et.shape, numpy.nan, dtype='float32')
+            r_month_et = bottleneck.nanrankdata(month_et[:, valid_cells], axis=0)
+            pr_month_et[:, valid_cells] = (r_month_et - 0.5) / numpy.count_nonzero(~invalid[:, valid_cells], axis=0)
+            m_pr_month_et = numpy.ma.array(pr_month_et, mask=invalid)
+
+            # Every year of this month is written in one call. Writing the whole variable at once would mean holding
+            # all of it in memory, which is too much for long, fine-resolution records.
+            dataset[var][i_list] = m_pr_month_et
     dataset.close()
 
 
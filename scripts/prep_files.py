@@ -8,12 +8,15 @@ import glob
 import logging
 import warnings
 import shutil
-import calendar
-import math
 import numpy
+import bottleneck
+import netCDF4
 from cartopy.io import shapereader
 import multiprocessing
-import rioxarray
+import hashlib
+import json
+import rasterio.features
+import rasterio.transform
 
 logging.basicConfig(level=logging.WARN, format="%(asctime)s %(levelname)s: %(message)s", datefmt="%Y-%m-%d  %H:%M:%S")
 LOGGER = logging.getLogger(__name__)
@@ -26,6 +29,21 @@ CALC_MORE_TIME_PERIODS = ['monthly_et_short_crop', 'ndvi', 'soil_moisture']
 OTHER_DATASETS = ['soil_moisture', 'ndvi']
 DEFAULT_PATH = 'data/{dataset}/{year}.{dataset}.{filetype}'
 DAILY_DATASETS = ['daily_rain', 'et_short_crop', 'max_temp', 'min_temp']
+# The daily datasets each computed dataset is made from
+MONTHLY_INPUTS = {'monthly_avg_temp': ['max_temp', 'min_temp'], 'monthly_et_short_crop': ['et_short_crop']}
+# Side variables that aren't needed in the merged files. Dropping them when the files are opened means they're never
+# decoded.
+UNUSED_VARIABLES = ['crs', 'time_bnds', 'lat_bnds', 'lon_bnds']
+# Dask chunks for files that aren't stored in chunks
+DEFAULT_CHUNKS = {'time': 10}
+AUSTRALIA_SHAPEFILE = 'shapes/gadm36_AUS_0.shp'
+# File extensions of the formats the merged files can be saved in. save_to_netcdf() writes a Zarr store for .zarr paths.
+FILE_EXTENSIONS = {'netcdf': '.nc', 'zarr': '.zarr'}
+# How merge_years() stores the merged files: the whole grid and MERGED_TIME_CHUNK time steps in each chunk. These are
+# recorded in the manifest, so changing them means the files are merged again.
+MERGED_TIME_ENCODING = {'units': 'days since 1889-01', '_FillValue': None}
+MERGED_VARIABLE_ENCODING = {'complevel': 4, 'shuffle': True}
+MERGED_TIME_CHUNK = 10
 
 
 def main():
@@ -41,24 +59,27 @@ def main():
     else:
         number_of_worker_processes = multiprocessing.cpu_count() - 1
 
+    # Each dataset is merged in its own process. The pool is never bigger than the number of datasets.
     job_data = []
     for dataset_name in options.datasets:
         if dataset_name in DOWNLOADED_DATASETS + OTHER_DATASETS:
             job_data.append((dataset_name, options))
-    pool = multiprocessing.Pool(number_of_worker_processes)
-    pool.map(process_dataset, job_data)
-    pool.close()
-    pool.join()
+    run_jobs(process_dataset, job_data, number_of_worker_processes)
 
-    # monthly_avg_temp and monthly_et_short_crop can't be calculated until max_temp, min_temp and et_short_crop are done
+    # monthly_avg_temp and monthly_et_short_crop can't be calculated until max_temp, min_temp and et_short_crop are
+    # done. Their yearly daily files are made monthly first, each file in its own process.
+    job_data = []
+    for dataset_name in options.datasets:
+        if dataset_name in COMPUTED_DATASETS:
+            for input_dataset in MONTHLY_INPUTS[dataset_name]:
+                for path in glob.glob(options.path.format(dataset=input_dataset, year='*', filetype='nc')):
+                    job_data.append((input_dataset, path, options.verbose))
+    run_jobs(calc_monthly_file, job_data, number_of_worker_processes)
     job_data = []
     for dataset_name in options.datasets:
         if dataset_name in COMPUTED_DATASETS:
             job_data.append((dataset_name, options))
-    pool = multiprocessing.Pool(number_of_worker_processes)
-    pool.map(process_dataset, job_data)
-    pool.close()
-    pool.join()
+    run_jobs(process_dataset, job_data, number_of_worker_processes)
 
     end_time = datetime.now()
     LOGGER.info('End time: ' + str(end_time))
@@ -66,6 +87,22 @@ def main():
     LOGGER.info('Elapsed time: ' + str(elapsed_time))
 
 
+def run_jobs(function, job_data, number_of_worker_processes):
+    """
+    Runs function for each job, with up to number_of_worker_processes jobs at a time.
+
+    :param function: Function that takes a single job's arguments, e.g. process_dataset()
+    :param job_data: List of arguments, one for each job
+    :param number_of_worker_processes: Maximum number of processes to use
+    """
+    if len(job_data) == 0:
+        return
+    pool = multiprocessing.Pool(max(1, min(number_of_worker_processes, len(job_data))))
+    pool.map(function, job_data, chunksize=1)
+    pool.close()
+    pool.join()
+
+
 def process_dataset(job_args):
     dataset_name, options = job_args
     LOGGER.setLevel(options.verbose)
@@ -73,18 +110,17 @@ def process_dataset(job_args):
     # Create folder for results
     os.makedirs(os.path.dirname(options.path.format(dataset=dataset_name, year='', filetype='-')), exist_ok=True)
     if dataset_name not in COMPUTED_DATASETS + OTHER_DATASETS:
-        merge_years(dataset_name, options.path)
+        merge_years(dataset_name, options.path, options.compression, options.format)
     if 'monthly_avg_temp' == dataset_name:
-        calc_monthly_avg_temp(options.path)
+        calc_monthly_avg_temp(options.path, options.compression, options.format)
     if 'monthly_et_short_crop' == dataset_name:
-        calc_monthly_et_short_crop(options.path)
+        calc_monthly_et_short_crop(options.path, options.compression, options.format)
     if 'soil_moisture' == dataset_name:
-        combine_soil_moisture(options.path)
+        combine_soil_moisture(options.path, options.compression, options.format)
     if 'ndvi' == dataset_name:
-        combine_ndvi(options.path)
+        combine_ndvi(options.path, options.compression, options.format)
     if dataset_name in CALC_MORE_TIME_PERIODS:
-        for scale in [3, 6, 9, 12, 24, 36]:
-            avg_over_period(dataset_name, options.path, scale)
+        avg_over_period(dataset_name, options.path, [3, 6, 9, 12, 24, 36], options.compression, options.format)
 
 
 def get_options():
@@ -129,104 +165,272 @@ def get_options():
         choices=["single", "all_but_one", "all"],
         default="all_but_one",
     )
+    optional.add_argument(
+        '--compression',
+        help='How to compress the merged files, including soil moisture, NDVI and the averages over longer periods. '
+             'zstd and blosc_zstd are much faster to write than zlib, but need netCDF4 1.6+ and can only be read '
+             'where the netCDF library has those filters.',
+        choices=['zlib', 'zstd', 'blosc_zstd'],
+        default='zlib'
+    )
+    optional.add_argument(
+        '--format',
+        help='File format of the merged files. Zarr stores can be read in parallel chunk by chunk, which is faster for '
+             'the averages over longer periods, but the climate indices tool and the later scripts only read netCDF. '
+             '--compression only applies to netCDF.',
+        choices=list(FILE_EXTENSIONS.keys()),
+        default='netcdf'
+    )
     args = parser.parse_args()
-    if args.datasets == 'all':
+    if 'all' in args.datasets:
         args.datasets = DOWNLOADED_DATASETS + COMPUTED_DATASETS
     return args
 
 
-def calc_monthly_avg_temp(file_path):
+def calc_monthly_file(job_args):
+    """
+    Makes one yearly file of a daily dataset monthly, saving it as the matching file of monthly_<dataset>. Temperatures
+    are averaged over the month and evapotranspiration is summed.
+
+    :param job_args: Tuple of the daily dataset's name, the path of the yearly file and the logging level
+    """
+    input_dataset, path, verbose = job_args
+    LOGGER.setLevel(verbose)
+    LOGGER.info('Calculating monthly ' + path)
+    with xarray.open_dataset(path, drop_variables=['crs']) as dataset:
+        # If the last month is incomplete we should drop it
+        dataset = drop_incomplete_months(dataset)
+        if input_dataset == 'et_short_crop':
+            monthly_dataset = dataset.resample(time='M').sum(skipna=False, keep_attrs=True)
+        else:
+            # We expect warnings here about means of empty slices, just ignore them
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                monthly_dataset = dataset.resample(time='M').mean()
+                monthly_dataset = monthly_dataset.transpose('lat', 'lon', 'time')
+            monthly_dataset[input_dataset].attrs['units'] = dataset[input_dataset].units
+        monthly_dataset = utils.truncate_time_dim(monthly_dataset)
+        output_file_path = path.replace(input_dataset, 'monthly_' + input_dataset)
+        utils.save_to_netcdf(monthly_dataset, output_file_path, logging_level=logging.WARN)
+
+
+def calc_monthly_avg_temp(file_path, compression='zlib', file_format='netcdf'):
     # Too much data to merge min_temp and max_temp, then calculate average temperature for the whole thing
-    # Convert all to monthly, then merge and calculate avg temperature
-    input_datasets = ['max_temp', 'min_temp']
-    for input_dataset in input_datasets:
-        LOGGER.info('Calculating monthly ' + input_dataset)
-        paths = glob.glob(file_path.format(dataset=input_dataset, year='*', filetype='nc'))
-        for path in paths:
-            with xarray.open_dataset(path) as dataset:
-                # If the last month is incomplete we should drop it
-                dataset = drop_incomplete_months(dataset)
-
-                # We expect warnings here about means of empty slices, just ignore them
-                with warnings.catch_warnings():
-                    warnings.simplefilter('ignore', category=RuntimeWarning)
-                    monthly_dataset = dataset.drop_vars('crs', errors='ignore').resample(time='M').mean()
-                    monthly_dataset = monthly_dataset.transpose('lat', 'lon', 'time')
-                monthly_dataset = utils.truncate_time_dim(monthly_dataset)
-                monthly_dataset[input_dataset].attrs['units'] = dataset[input_dataset].units
-                output_file_path = path.replace(input_dataset, 'monthly_' + input_dataset)
-                utils.save_to_netcdf(monthly_dataset, output_file_path, logging_level=logging.WARN)
-        merge_years('monthly_' + input_dataset, file_path)
+    # The yearly files have already been made monthly by calc_monthly_file(). Those of both datasets are opened together
+    # and averaged straight into the merged file, without merging each dataset to its own file first.
     LOGGER.info('Calculating monthly average temperature.')
-    files = [get_merged_dataset_path(file_path, 'monthly_' + x) for x in input_datasets]
-    with xarray.open_mfdataset(files, chunks={'time': 10}, combine='by_coords') as dataset:
-        dataset['avg_temp'] = (dataset.max_temp + dataset.min_temp) / 2
+    files = []
+    for input_dataset in MONTHLY_INPUTS['monthly_avg_temp']:
+        files += sorted(glob.glob(file_path.format(dataset='monthly_' + input_dataset, year='*', filetype='nc')))
+    with xarray.open_mfdataset(files, chunks=get_native_chunks(files), combine='by_coords', parallel=True,
+                               engine='h5netcdf', drop_variables=UNUSED_VARIABLES, data_vars='minimal',
+                               coords='minimal', compat='override') as dataset:
+        # Averaged in one blockwise task per chunk, without a full-size intermediate sum
+        dataset['avg_temp'] = xarray.apply_ufunc(mean_of_two, dataset.max_temp, dataset.min_temp, dask='parallelized',
+                                                 output_dtypes=[dataset.max_temp.dtype])
         dataset['avg_temp'].attrs['units'] = dataset.max_temp.units
         # Dimensions must be in this order to be accepted by the climate indices tool
-        dataset = dataset.drop_vars(['max_temp', 'min_temp', 'crs'], errors='ignore').transpose('lat', 'lon', 'time')
-        output_file_path = get_merged_dataset_path(file_path, 'monthly_avg_temp')
-        utils.save_to_netcdf(dataset, output_file_path)
+        dataset = dataset.drop_vars(['max_temp', 'min_temp']).transpose('lat', 'lon', 'time')
+        output_file_path = get_merged_dataset_path(file_path, 'monthly_avg_temp', file_format)
+        encoding = {'time': {'units': 'days since 1889-01', '_FillValue': None}}
+        # Stored to the hundredth of a degree, well within the range of 16 bit integers
+        utils.save_to_netcdf(dataset, output_file_path, encoding=encoding, compression=compression,
+                             quantize={'avg_temp': (0.01, 0.0)})
+
+
+def mean_of_two(first, second):
+    """
+    Element-wise mean of two NumPy arrays, for use with xarray.apply_ufunc.
+    """
+    result = numpy.add(first, second)
+    result *= 0.5
+    return result
 
 
-def calc_monthly_et_short_crop(file_path):
+def calc_monthly_et_short_crop(file_path, compression='zlib', file_format='netcdf'):
     LOGGER.info('Calculating monthly short crop evapotranspiration.')
     # Too much data to merge et_short_crop and then calculate monthly.
-    # So we calculate monthly for each individual file then merge
-    et_paths = glob.glob(file_path.format(dataset='et_short_crop', year='*', filetype='nc'))
-    for et_path in et_paths:
-        with xarray.open_dataset(et_path, drop_variables=['crs']) as dataset:
-            # If the last month is incomplete we should drop it
-            dataset = drop_incomplete_months(dataset)
-            dataset = dataset.resample(time='M').sum(skipna=False, keep_attrs=True)
-            dataset = utils.truncate_time_dim(dataset)
-            output_file_path = et_path.replace('et_short_crop', 'monthly_et_short_crop')
-            utils.save_to_netcdf(dataset, output_file_path)
-    merge_years('monthly_et_short_crop', file_path)
+    # So each individual file has been made monthly by calc_monthly_file(), and those are merged
+    merge_years('monthly_et_short_crop', file_path, compression, file_format)
 
 
-def merge_years(dataset_name, file_path):
+def merge_years(dataset_name, file_path, compression='zlib', file_format='netcdf'):
     LOGGER.info('Merging files for: ' + dataset_name)
-    output_path = get_merged_dataset_path(file_path, dataset_name)
-    inputs_path = file_path.format(dataset=dataset_name, year='*', filetype='nc')
-    with xarray.open_mfdataset(inputs_path, chunks={'time': 10}, combine='by_coords', parallel=True, engine='h5netcdf', drop_variables=['crs']) as dataset:
+    output_path = get_merged_dataset_path(file_path, dataset_name, file_format)
+    # Listed once, and the same list is hashed for the manifest and opened
+    input_paths = sorted(glob.glob(file_path.format(dataset=dataset_name, year='*', filetype='nc')))
+    # A manifest of the yearly files is kept beside the merged file, so the merge can be skipped if none have changed
+    manifest_path = output_path + '.manifest.json'
+    previous_manifest = read_manifest(manifest_path)
+    manifest = {
+        'compression': compression,
+        'file_format': file_format,
+        'encoding': {'time': MERGED_TIME_ENCODING, 'variables': MERGED_VARIABLE_ENCODING,
+                     'time_chunk': MERGED_TIME_CHUNK},
+        'files': get_file_manifest(input_paths, previous_manifest.get('files', {}))
+    }
+    if os.path.exists(output_path) and manifests_match(previous_manifest, manifest):
+        LOGGER.info('Yearly files unchanged since the last merge, skipping: ' + dataset_name)
+        # Saved again in case only modification times changed, so those files aren't hashed again next time
+        write_manifest(manifest_path, manifest)
+        return
+    # The yearly files share their grid, so only the time coordinate and variables along it are concatenated, and the
+    # other coordinates are taken from the first file instead of being compared across every file
+    with xarray.open_mfdataset(input_paths, chunks=get_native_chunks(input_paths), combine='by_coords', parallel=True,
+                               engine='h5netcdf', drop_variables=UNUSED_VARIABLES, data_vars='minimal',
+                               coords='minimal', compat='override') as dataset:
         # Dimensions must be in this order to be accepted by the climate indices tool
         dataset = dataset.transpose('lat', 'lon', 'time')
+        # Each file is read along its own chunks, then rechunked to the chunks of the merged file, so every write
+        # fills whole chunks
+        time_chunk = min(dataset.sizes['time'], MERGED_TIME_CHUNK)
+        dataset = dataset.chunk({'lat': -1, 'lon': -1, 'time': time_chunk})
         if dataset_name not in DAILY_DATASETS:
             dataset = utils.truncate_time_dim(dataset)
-        encoding = {'time': {'units': 'days since 1889-01', '_FillValue': None}}
-        utils.save_to_netcdf(dataset, output_path, encoding=encoding)
+        encoding = {'time': dict(MERGED_TIME_ENCODING)}
+        # Chunk the file the same way it's read: the whole grid, a few time steps at a time. save_to_netcdf() adds the
+        # compression filter.
+        for var in dataset.data_vars:
+            if dataset[var].dims != ('lat', 'lon', 'time'):
+                continue
+            encoding[var] = {
+                **MERGED_VARIABLE_ENCODING,
+                'chunksizes': (dataset.sizes['lat'], dataset.sizes['lon'], time_chunk)
+            }
+        # Written beside the merged file first and only moved into place once it's complete, so a failed merge never
+        # leaves a broken file that the manifest says is up to date
+        root, extension = os.path.splitext(output_path)
+        temp_path = root + '.temp' + extension
+        saved = utils.save_to_netcdf(dataset, temp_path, encoding=encoding, compression=compression)
+    if not saved:
+        LOGGER.error('Could not merge files for: ' + dataset_name)
+        remove_path(temp_path)
+        return
+    # A Zarr store is a directory, which can't be replaced while it has anything in it
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+    os.replace(temp_path, output_path)
+    write_manifest(manifest_path, manifest)
+
+
+def remove_path(path):
+    """
+    Removes a file or a directory (such as a Zarr store), if there's anything at the path.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
 
 
-def get_merged_dataset_path(file_path, dataset_name):
+def get_native_chunks(paths):
+    """
+    Gets the chunk sizes the first of some netCDF files is stored with, for reading them as dask chunks that line up
+    with the chunks on disk. Falls back to DEFAULT_CHUNKS if the files aren't stored in chunks.
+
+    :param paths: Paths of netCDF files that are stored the same way
+    :return: Dictionary of dimension name to chunk size
+    """
+    if len(paths) == 0:
+        return DEFAULT_CHUNKS
+    with netCDF4.Dataset(paths[0]) as dataset:
+        for variable in dataset.variables.values():
+            if 'time' not in variable.dimensions or len(variable.dimensions) < 2:
+                continue
+            chunking = variable.chunking()
+            if chunking != 'contiguous':
+                return dict(zip(variable.dimensions, chunking))
+    return DEFAULT_CHUNKS
+
+
+def read_manifest(manifest_path):
+    """
+    Reads a manifest written by merge_years(), or returns an empty one if there isn't one.
+    """
+    try:
+        with open(manifest_path) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(manifest_path, manifest):
+    with open(manifest_path, 'w') as file:
+        json.dump(manifest, file, indent=1)
+
+
+def get_file_manifest(paths, previous_files):
+    """
+    Describes each file by its modification time, size and sha1 hash. Files with the same modification time and size
+    as in the previous manifest keep their previous hash, so only files that look changed are read.
+
+    :param paths: Paths of the files to describe
+    :param previous_files: The 'files' section of the previous manifest
+    :return: Dictionary of path to [modification time, size, sha1]
+    """
+    files = {}
+    for path in paths:
+        stat = os.stat(path)
+        previous = previous_files.get(path)
+        if previous is not None and previous[0] == stat.st_mtime and previous[1] == stat.st_size:
+            files[path] = previous
+        else:
+            files[path] = [stat.st_mtime, stat.st_size, hash_file(path)]
+    return files
+
+
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def manifests_match(first, second):
+    """
+    Checks whether two manifests describe the same files with the same contents, saved with the same settings (format,
+    compression and encoding). Modification times don't matter as long as the hashes match.
+    """
+    if len(first) == 0 or any(first.get(key) != value for key, value in second.items() if key != 'files'):
+        return False
+    first_hashes = {path: description[2] for path, description in first['files'].items()}
+    second_hashes = {path: description[2] for path, description in second['files'].items()}
+    return first_hashes == second_hashes
+
+
+def get_merged_dataset_path(file_path, dataset_name, file_format='netcdf'):
     merged_file_path = file_path.format(dataset=dataset_name, year='', filetype='a')
-    return os.path.dirname(merged_file_path) + '/full_' + dataset_name + '.nc'
+    return os.path.dirname(merged_file_path) + '/full_' + dataset_name + FILE_EXTENSIONS[file_format]
 
 
-def combine_soil_moisture(file_path):
+def combine_soil_moisture(file_path, compression='zlib', file_format='netcdf'):
     # Soil moisture is given as two files - one is historical data and the other is recent data downloaded from BoM.
     # There is some overlap. We need to combine these files while giving precedence to the recent data downloaded from
     # BoM
     LOGGER.info('Merging files for: soil_moisture')
     archive_dataset_path = file_path.format(dataset='soil_moisture', year='archive', filetype='nc')
     realtime_dataset_path = file_path.format(dataset='soil_moisture', year='realtime', filetype='nc')
-    output_file_path = get_merged_dataset_path(file_path, 'soil_moisture')
+    output_file_path = get_merged_dataset_path(file_path, 'soil_moisture', file_format)
     try:
-        archive_dataset = xarray.open_dataset(archive_dataset_path, chunks={'time': 10})
+        archive_dataset = xarray.open_dataset(archive_dataset_path, chunks=get_native_chunks([archive_dataset_path]),
+                                              drop_variables=['time_bnds'])
     except FileNotFoundError:
         logging.warning('Historical data for soil moisture not found. Proceeding with recent data only. If you meant '
                         'to include historical data, please place it at: ' + archive_dataset_path)
-        shutil.copyfile(realtime_dataset_path, output_file_path)
+        # Saved again rather than copied, so it's stored in the same format and compression as the other merged files
+        with xarray.open_dataset(realtime_dataset_path, chunks={}) as realtime_dataset:
+            utils.save_to_netcdf(realtime_dataset, output_file_path, compression=compression)
         return
-    archive_dataset = archive_dataset.drop_vars('time_bnds', errors='ignore')
-    realtime_dataset = xarray.open_dataset(realtime_dataset_path, chunks={'time': 10})
+    realtime_dataset = xarray.open_dataset(realtime_dataset_path, chunks=get_native_chunks([realtime_dataset_path]))
     date = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     date = date - relativedelta(months=1)
     realtime_dataset = realtime_dataset.sel(time=slice('1800-01', date))
     combined = realtime_dataset.combine_first(archive_dataset)
-    utils.save_to_netcdf(combined, output_file_path)
+    utils.save_to_netcdf(combined, output_file_path, compression=compression)
 
 
-def combine_ndvi(file_path):
+def combine_ndvi(file_path, compression='zlib', file_format='netcdf'):
     # NDVI is given as a 1km resolution archive combined with a 300m resolution near real time dataset.
     # There are several entries per month, which need to be aggregated as well.
     LOGGER.info('Regridding NDVI')
@@ -248,30 +452,76 @@ def combine_ndvi(file_path):
 
     # Combine archive and realtime parts
     LOGGER.info('Merging files for: ndvi')
+    archive_paths = sorted(glob.glob(file_path.format(dataset='ndvi', year='5km.archive.*', filetype='nc')))
     with xarray.open_mfdataset(
-        file_path.format(dataset='ndvi', year='5km.archive.*', filetype='nc'),
-        chunks={'time': 10},
-        combine='by_coords'
+        archive_paths,
+        chunks=get_native_chunks(archive_paths),
+        combine='by_coords',
+        parallel=True,
+        engine='h5netcdf',
+        data_vars='minimal',
+        coords='minimal',
+        compat='override'
     ) as archive_dataset:
         archive_dataset = archive_dataset.resample(time='1MS').mean()
         files = glob.glob(file_path.format(dataset='ndvi', year='5km.realtime.*', filetype='nc'))
-        time_dim = xarray.Variable('time', [datetime.strptime(file.split('.')[2], '%Y-%m-%d') for file in files])
+        # The dates in the file names are ISO 8601 (YYYY-MM-DD), which numpy parses directly
+        dates = numpy.array([file.split('.')[2] for file in files], dtype='datetime64[ns]')
+        time_dim = xarray.DataArray(dates, dims='time', name='time')
         if len(files) == 0:
             full_dataset = archive_dataset
         else:
-            realtime_dataset = xarray.concat([xarray.open_dataset(f) for f in files], dim=time_dim)
+            # Time is a new dimension here, so the data variables are all concatenated, but the shared grid is still
+            # taken from the first file
+            realtime_dataset = xarray.open_mfdataset(files, concat_dim=time_dim, combine='nested', parallel=True,
+                                                     engine='h5netcdf', coords='minimal', compat='override')
             realtime_dataset = realtime_dataset.sortby('time')
             realtime_dataset = realtime_dataset.resample(time='1MS').mean()
             realtime_dataset['lat'] = archive_dataset.lat
             realtime_dataset['lon'] = archive_dataset.lon
             full_dataset = archive_dataset.combine_first(realtime_dataset)
-        shape = read_shape('shapes/gadm36_AUS_0.shp')
-        regions = [record.geometry for record in shape.records() if record.attributes['NAME_0'] == 'Australia']
-        full_dataset.rio.write_crs('epsg:4326', inplace=True).rio.clip(regions, all_touched=True)
-        full_dataset = full_dataset.drop_vars('spatial_ref')
+        output_file_path = get_merged_dataset_path(file_path, 'ndvi', file_format)
+        mask = get_australia_mask(full_dataset.lat.values, full_dataset.lon.values, os.path.dirname(output_file_path))
+        full_dataset = full_dataset.where(mask)
         full_dataset = full_dataset.rename({'NDVI': 'ndvi', 'lat': 'latitude', 'lon': 'longitude'})
-        output_file_path = get_merged_dataset_path(file_path, 'ndvi')
-        utils.save_to_netcdf(full_dataset, output_file_path)
+        utils.save_to_netcdf(full_dataset, output_file_path, compression=compression)
+
+
+def get_australia_mask(lat, lon, cache_dir):
+    """
+    Gets a mask of the grid cells touching Australia, from AUSTRALIA_SHAPEFILE. Rasterising the shapes on a fine grid is
+    slow, so the mask is saved in cache_dir and reused for as long as the grid and the shapefile's files stay the same.
+
+    :param lat: Evenly spaced latitudes of the grid
+    :param lon: Evenly spaced longitudes of the grid
+    :param cache_dir: Folder to save the mask in
+    :return: Boolean DataArray over lat and lon, True inside Australia
+    """
+    # The key covers every file of the shapefile (.shp, .dbf, .prj, etc.), since the attributes and projection decide
+    # the mask as much as the shapes do
+    key = hashlib.sha1(lat.tobytes() + lon.tobytes())
+    for path in sorted(glob.glob(os.path.splitext(AUSTRALIA_SHAPEFILE)[0] + '.*')):
+        key.update(os.path.basename(path).encode())
+        with open(path, 'rb') as file:
+            key.update(file.read())
+    key = key.hexdigest()
+    cache_path = os.path.join(cache_dir, 'australia_mask.' + key + '.nc')
+    if os.path.isfile(cache_path):
+        with xarray.open_dataarray(cache_path) as mask:
+            return mask.load()
+    shape = read_shape(AUSTRALIA_SHAPEFILE)
+    regions = [record.geometry for record in shape.records() if record.attributes['NAME_0'] == 'Australia']
+    # The coordinates are the centres of the grid cells, so the grid's corner is half a cell away from the first one
+    lat_step = lat[1] - lat[0]
+    lon_step = lon[1] - lon[0]
+    transform = rasterio.transform.Affine.translation(lon[0] - lon_step / 2, lat[0] - lat_step / 2) \
+        * rasterio.transform.Affine.scale(lon_step, lat_step)
+    inside = rasterio.features.geometry_mask(regions, out_shape=(lat.size, lon.size), transform=transform,
+                                             all_touched=True, invert=True)
+    mask = xarray.DataArray(inside, coords={'lat': lat, 'lon': lon}, dims=('lat', 'lon'), name='australia')
+    os.makedirs(cache_dir, exist_ok=True)
+    mask.to_netcdf(cache_path)
+    return mask
 
 
 def read_shape(shapefile=None):
@@ -285,20 +535,24 @@ def read_shape(shapefile=None):
 
 def regrid_ndvi(input_path, output_path, chunks):
     with xarray.open_dataset(
-        input_path, chunks=chunks, mask_and_scale=False
+        input_path, chunks=chunks, mask_and_scale=False,
+        drop_variables=['crs', 'TIME_GRID', 'NDVI_unc', 'NOBS', 'QFLAG', 'spatial_ref']
     ) as dataset:
-        dataset = dataset.drop_vars(['crs', 'TIME_GRID', 'NDVI_unc', 'NOBS', 'QFLAG', 'spatial_ref'], errors='ignore')
-        dataset = dataset.where(dataset.lon >= 112.0, drop=True)
-        dataset = dataset.where(dataset.lon <= 154.0, drop=True)
-        dataset = dataset.where(dataset.lat >= -44.0, drop=True)
-        dataset = dataset.where(dataset.lat <= -10, drop=True)
+        # Crop to Australia by indexing the coordinates, which doesn't touch the data. The bounds are checked rather
+        # than sliced, so it works whichever way the latitudes run.
+        dataset = dataset.isel(
+            lat=((dataset.lat >= -44.0) & (dataset.lat <= -10)).values,
+            lon=((dataset.lon >= 112.0) & (dataset.lon <= 154.0)).values
+        )
         dataset = dataset.where(dataset.NDVI != 254)
+        # Interpolate one dimension at a time. Only the dimension being interpolated needs to be in a single chunk, so
+        # the full resolution grid is never loaded at once.
         dataset = dataset.chunk(chunks={'lat': -1})
         model_lat = numpy.arange(-44.0, -9.975, 0.05)
         dataset = dataset.interp(lat=model_lat)
         dataset = dataset.chunk(chunks={'lon': -1})
-        model_lat = numpy.arange(112.0, 154.025, 0.05)
-        dataset = dataset.interp(lon=model_lat)
+        model_lon = numpy.arange(112.0, 154.025, 0.05)
+        dataset = dataset.interp(lon=model_lon)
         dataset['lat'].attrs['units'] = 'degrees_north'
         dataset['lat'].attrs['axis'] = 'Y'
         dataset['lon'].attrs['units'] = 'degrees_east'
@@ -307,59 +561,89 @@ def regrid_ndvi(input_path, output_path, chunks):
 
 
 def drop_incomplete_months(dataset):
-    last_date = dataset['time'].values[dataset['time'].values.size - 1].astype('<M8[D]').item()
-    last_day_of_month = calendar.monthrange(last_date.year, last_date.month)[1]
-    if last_date.day != last_day_of_month:
-        last_valid_day = last_date.replace(
-            month=last_date.month - 1,
-            day=calendar.monthrange(last_date.year, last_date.month - 1)[1]
-        )
-        return dataset.sel(time=slice('1890-01-01', last_valid_day))
+    last_date = dataset['time'].values[-1].astype('<M8[D]')
+    last_month = last_date.astype('<M8[M]')
+    last_day_of_month = (last_month + numpy.timedelta64(1, 'M')).astype('<M8[D]') - numpy.timedelta64(1, 'D')
+    if last_date != last_day_of_month:
+        # Keep everything up to the end of the previous month, which also works when the last date is in January
+        last_valid_day = last_month.astype('<M8[D]') - numpy.timedelta64(1, 'D')
+        return dataset.sel(time=slice(None, str(last_valid_day)))
     return dataset
 
 
-def avg_over_period(dataset_name, file_path, scale):
-    LOGGER.info('Calculating {} over {} months.'.format(dataset_name, scale))
-    new_var_name = '{}_{}'.format(dataset_name, scale)
-    input_path = get_merged_dataset_path(file_path, dataset_name)
-    output_path = get_merged_dataset_path(file_path, new_var_name)
+def avg_over_period(dataset_name, file_path, scales, compression='zlib', file_format='netcdf'):
+    input_path = get_merged_dataset_path(file_path, dataset_name, file_format)
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', category=RuntimeWarning)
-        with xarray.open_dataset(input_path) as dataset:
-            # The rolling mean operation fails if the last chunk length is lower than scale / 2
-            # But chunks still need to be used or the program will run out of memory
-            chunk_length = math.ceil(scale/2)
-            while True:
-                last_chunk_length = dataset['time'].size % chunk_length
-                if last_chunk_length == 0 or last_chunk_length >= scale/2 or last_chunk_length >= dataset['time'].size:
-                    break
-                chunk_length += 1
-            dataset = dataset.chunk({'time': chunk_length})
+        # Opened once for every scale, with the file's own chunks, which are then split up
+        with xarray.open_dataset(input_path, chunks={}) as dataset:
             var = list(dataset.keys())[0]
-            dataset[new_var_name] = dataset[var].rolling(time=scale, min_periods=scale).construct('window').\
-                mean('window')
-            # This operation doesn't account for missing time entries. We need to remove results around those time gaps
-            # that shouldn't have enough data to exist.
-            time = dataset['time'].values
-            dates_to_remove = []
-            for i in range(len(time)):
-                if i < scale-1:
-                    dates_to_remove.append(time[i])
-                    continue
-                # Get slice of dates for the size of the window
-                window_dates = time[i - scale + 1:i + 1]
-                first_date = window_dates[0].astype('<M8[M]').item()
-                last_date = window_dates[-1].astype('<M8[M]').item()
-                if ((last_date.year - first_date.year) * 12 + last_date.month - first_date.month) >= scale:
-                    dates_to_remove.append(time[i])
-            dataset = dataset.drop_sel(time=dates_to_remove)
-            # Drop all input variables and anything else that slipped in, we ONLY want the new CDI.
-            keys = dataset.keys()
-            for key in keys:
-                if key != new_var_name:
-                    dataset = dataset.drop_vars(key)
-            dataset = dataset.dropna('time', how='all')
-            utils.save_to_netcdf(dataset, output_path)
+            # The moving mean runs along the whole record of each grid cell, so the data is chunked over the grid
+            # instead of over time. Chunks still need to be used or the program will run out of memory. Time stays the
+            # last dimension, so each cell's record is contiguous in memory for the moving mean.
+            dataset = dataset.chunk({dim: -1 if dim == 'time' else 'auto' for dim in dataset[var].dims})
+            months = dataset['time'].values.astype('<M8[M]').astype(int)
+            # Whether each time step has data anywhere on the grid. It's computed along with the results, so the input
+            # is only read once.
+            grid_dims = [dim for dim in dataset[var].dims if dim != 'time']
+            has_data = dataset[var].notnull().any(grid_dims)
+            complete_times = []
+            results = []
+            output_paths = []
+            for scale in scales:
+                LOGGER.info('Calculating {} over {} months.'.format(dataset_name, scale))
+                new_var_name = '{}_{}'.format(dataset_name, scale)
+                output_path = get_merged_dataset_path(file_path, new_var_name, file_format)
+                # Mean of the values present in each window, without building the windows as an extra dimension
+                result = xarray.apply_ufunc(
+                    bottleneck.move_mean, dataset[var],
+                    input_core_dims=[['time']],
+                    output_core_dims=[['time']],
+                    dask='parallelized',
+                    output_dtypes=[numpy.result_type(dataset[var].dtype, numpy.float32)],
+                    kwargs={'window': scale, 'min_count': 1, 'axis': -1}
+                )
+                # This operation doesn't account for missing time entries. We need to remove results around those time
+                # gaps that shouldn't have enough data to exist.
+                # A window is only complete if its first and last months are less than scale months apart, and the
+                # first scale - 1 time steps never have a full window.
+                incomplete = numpy.ones(months.size, dtype=bool)
+                incomplete[scale - 1:] = months[scale - 1:] - months[:max(0, months.size - scale + 1)] >= scale
+                complete_times.append(~incomplete)
+                results.append(result.isel(time=~incomplete).to_dataset(name=new_var_name))
+                output_paths.append(output_path)
+            # Computed together, so each chunk of the merged file is read and decompressed once for all the scales
+            computed = utils.save_many_to_netcdf(results, output_paths, compression=compression,
+                                                 compute_with=[has_data])
+    if computed is None:
+        LOGGER.error('Could not save the averages over longer periods for: ' + dataset_name)
+        return
+    has_data = computed[0].values.astype('float32')
+    # Results with no data anywhere are dropped too. A mean only has data somewhere if a time step in its window does.
+    # These are rare (gaps in the record), so the few files that have them are saved again without them.
+    for scale, complete, output_path in zip(scales, complete_times, output_paths):
+        empty = bottleneck.move_max(has_data, window=scale, min_count=1)[complete] == 0
+        if empty.any():
+            drop_time_steps(output_path, empty, compression)
+
+
+def drop_time_steps(path, drop, compression='zlib'):
+    """
+    Saves a file again without some of its time steps, replacing the original.
+
+    :param path: Path of the netCDF file or Zarr store
+    :param drop: Boolean array, True for each time step to drop
+    :param compression: Compression filter, if it's a netCDF file
+    """
+    root, extension = os.path.splitext(path)
+    temp_path = root + '.temp' + extension
+    with xarray.open_dataset(path, chunks={}) as dataset:
+        saved = utils.save_to_netcdf(dataset.isel(time=~drop), temp_path, compression=compression)
+    if not saved:
+        remove_path(temp_path)
+        return
+    remove_path(path)
+    os.replace(temp_path, path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+import os
+import sys
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.colors
+import matplotlib.pyplot
+import numpy
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), '..'), os.path.join(os.path.dirname(__file__), '..', 'scripts')]
+import generate_maps
+
+
+def test_imshow_colours_match_contourf():
+    """
+    Each level bin, and the values below and above the levels, should get the same colour from imshow as from contourf.
+    """
+    colours = ['#000000', '#111111', '#222222', '#333333', '#444444']
+    levels = numpy.array([0, 1, 2, 3], dtype='float32')
+    # One value below the levels, one in each bin, and one above the levels
+    values = numpy.array([-1, 0.5, 1.5, 2.5, 4], dtype='float32')
+
+    figure, ax = matplotlib.pyplot.subplots()
+    grid = numpy.arange(3)
+    contours = ax.contourf(grid, grid, numpy.resize(values, (3, 3)), levels, colors=colours, extend='both')
+    contour_colours = [matplotlib.colors.to_hex(colour) for colour in contours.get_facecolor()]
+    matplotlib.pyplot.close(figure)
+
+    cmap = matplotlib.colors.ListedColormap(colours)
+    norm = generate_maps.get_imshow_norm(levels, cmap)
+    imshow_colours = [matplotlib.colors.to_hex(cmap(norm(value))) for value in values]
+
+    assert contour_colours == colours
+    assert imshow_colours == contour_colours
@@ -1,4 +1,4 @@
-from utils.save_to_netcdf import save_to_netcdf
+from utils.save_to_netcdf import save_to_netcdf, save_many_to_netcdf
 from utils.other import get_lon_lat_names
 from utils.truncate_time_dim import truncate_time_dim
 
@@ -9,10 +9,16 @@ class LoggerWriter:
     def __init__(self, logger, level):
         self.logger = logger
         self.level = level
+        self.buffer = ''
 
     def write(self, message):
-        if message != '\n':
-            self.logger.log(self.level, message)
+        # A line can arrive over several writes, and progress bars start each update with a carriage return instead of
+        # ending it with a newline. Text is kept until its line is finished, then logged as one message.
+        self.buffer += message.replace('\r', '\n')
+        *lines, self.buffer = self.buffer.split('\n')
+        for line in lines:
+            if line:
+                self.logger.log(self.level, line)
 
     def flush(self):
         return
@@ -1,4 +1,7 @@
+import contextlib
 import os
+import dask
+import numpy
 from dask.diagnostics import ProgressBar
 from utils.logger_writer import LoggerWriter
 import logging
@@ -6,27 +9,210 @@ import logging
 """
 Saves an xarray Dataset to a netCDF file, with a progress bar (really common use case in this package).
 Can log to a given logger and logging level. If these are not provided, will log on level WARN
+Variables are compressed with zlib, unless another netCDF4 compression filter (e.g. zstd or blosc_zstd) is given.
+If the path ends in .zarr, a Zarr store is written instead, compressed with the zarr library's default codec.
+Errors are logged rather than raised, and the return value says whether the dataset was saved.
 """
 
+# Variables along time are chunked to about this many bytes, unless the caller chose chunk sizes. Big enough for the
+# compressor to work on whole blocks, small enough that reading one time step doesn't decompress much else.
+TARGET_CHUNK_BYTES = 1024 * 1024
+# Datasets smaller than this are computed into memory before writing, so the file is written in one go rather than
+# reopened for every dask chunk
+LOAD_THRESHOLD_BYTES = 1024 ** 3
+# The encoding settings that mean the same thing for Zarr as for netCDF. The rest (compression, chunk sizes) are
+# netCDF specific.
+ZARR_ENCODING_KEYS = ['units', 'calendar', 'dtype', '_FillValue', 'scale_factor', 'add_offset']
+# The encoding settings that pack a variable into integers. Packing carried over from a file the data was read from is
+# dropped, so values computed from packed data (e.g. percentile ranks) aren't rounded to the packed precision.
+PACKING_KEYS = ['dtype', 'scale_factor', 'add_offset', '_FillValue', 'missing_value']
 
-def save_to_netcdf(dataset, path, encoding=None, logging_level=logging.WARN):
-    logging.basicConfig(level=logging.WARN, format="%(asctime)s %(levelname)s: %(message)s",
-                        datefmt="%Y-%m-%d  %H:%M:%S")
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging_level)
-    logger.info('Saving ' + path)
+# Set up once when the module is imported, rather than on every save
+logging.basicConfig(level=logging.WARN, format="%(asctime)s %(levelname)s: %(message)s", datefmt="%Y-%m-%d  %H:%M:%S")
+LOGGER = logging.getLogger(__name__)
+
+
+def save_to_netcdf(dataset, path, encoding=None, logging_level=logging.WARN, compression='zlib', quantize=None):
+    LOGGER.setLevel(logging_level)
+    LOGGER.info('Saving ' + path)
     try:
         if len(os.path.dirname(path)) > 0:
             os.makedirs(os.path.dirname(path), exist_ok=True)
-        if encoding is None:
-            encoding = {}
-        for key in dataset.keys():
-            encoding[key] = {'zlib': True}
-        delayed_obj = dataset.to_netcdf(path, compute=False, format='NETCDF4', engine='netcdf4', unlimited_dims='time',
-                                        encoding=encoding)
-        # Write this to log instead of stdout
-        logger_writer = LoggerWriter(logger, logging.INFO)
-        with ProgressBar(out=logger_writer, dt=1):
-            delayed_obj.compute()
+        dataset = drop_inherited_packing(dataset)
+        encoding = dict(encoding) if encoding is not None else {}
+        # Variables with a known range and precision can be packed into 16 bit integers, which readers unpack with
+        # scale_factor and add_offset. quantize maps each of these variables to its (scale_factor, add_offset), or to
+        # None to spread the variable's own range over the 16 bit integers.
+        for key, packing_parameters in (quantize or {}).items():
+            scale_factor, add_offset = packing_parameters or get_packing_parameters(dataset[key])
+            packing = {'dtype': 'int16', 'scale_factor': scale_factor, 'add_offset': add_offset, '_FillValue': -32768}
+            encoding[key] = {**packing, **encoding.get(key, {})}
+        if path.endswith('.zarr'):
+            save_to_zarr(dataset, path, encoding)
+            return True
+        encoding = get_netcdf_encoding(dataset, encoding, compression)
+        # Time is left unlimited so more time steps can be appended later, but only if the dataset has a time dimension
+        unlimited_dims = ['time'] if 'time' in dataset.dims else []
+        if dataset.nbytes < LOAD_THRESHOLD_BYTES:
+            with get_progress_bar():
+                dataset = dataset.compute()
+            dataset.to_netcdf(path, format='NETCDF4', engine='netcdf4', unlimited_dims=unlimited_dims,
+                              encoding=encoding)
+        else:
+            delayed_obj = dataset.to_netcdf(path, compute=False, format='NETCDF4', engine='netcdf4',
+                                            unlimited_dims=unlimited_dims, encoding=encoding)
+            with get_progress_bar():
+                delayed_obj.compute()
+    except Exception as e:
+        LOGGER.error(e)
+        return False
+    return True
+
+
+def save_many_to_netcdf(datasets, paths, logging_level=logging.WARN, compression='zlib', compute_with=()):
+    """
+    Saves several xarray Datasets, computing them all together. Datasets made from the same input then share the work
+    of reading it, instead of it being read again for every file.
+
+    :param datasets: Datasets to save
+    :param paths: Path to save each dataset to. As with save_to_netcdf(), a path ending in .zarr is saved as Zarr.
+    :param logging_level: Level to log progress on
+    :param compression: Compression filter for the netCDF files, as for save_to_netcdf()
+    :param compute_with: Other dask-backed objects (e.g. summaries of the same input) to compute in the same pass
+    :return: List of the computed compute_with objects, or None if the datasets couldn't be saved
+    """
+    LOGGER.setLevel(logging_level)
+    try:
+        delayed_objs = []
+        for dataset, path in zip(datasets, paths):
+            LOGGER.info('Saving ' + path)
+            dataset = drop_inherited_packing(dataset)
+            if len(os.path.dirname(path)) > 0:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            if path.endswith('.zarr'):
+                delayed_objs.append(save_to_zarr(dataset, path, {}, compute=False))
+                continue
+            encoding = get_netcdf_encoding(dataset, {}, compression)
+            unlimited_dims = ['time'] if 'time' in dataset.dims else []
+            delayed_objs.append(dataset.to_netcdf(path, compute=False, format='NETCDF4', engine='netcdf4',
+                                                  unlimited_dims=unlimited_dims, encoding=encoding))
+        with get_progress_bar():
+            computed = dask.compute(*delayed_objs, *compute_with)
     except Exception as e:
-        logger.error(e)
+        LOGGER.error(e)
+        return None
+    return list(computed[len(delayed_objs):])
+
+
+def drop_inherited_packing(dataset):
+    """
+    Removes integer packing from the encoding variables carry over from the file they were read from. Packing can
+    still be asked for with the encoding or quantize arguments of save_to_netcdf().
+
+    :param dataset: Dataset to be saved
+    :return: Copy of the dataset without inherited packing
+    """
+    dataset = dataset.copy()
+    for key in dataset.keys():
+        encoding = dataset[key].encoding
+        if 'scale_factor' in encoding or 'add_offset' in encoding:
+            dataset[key].encoding = {name: value for name, value in encoding.items() if name not in PACKING_KEYS}
+    return dataset
+
+
+def get_netcdf_encoding(dataset, encoding, compression):
+    """
+    Adds the compression filter to the encoding of every variable, and chunk sizes to those along time, keeping any
+    other encoding the caller asked for. Compression other than zlib (e.g. zstd) needs netCDF4 1.6+, and the netCDF-C
+    library of anything reading the file must have the filter.
+
+    :param dataset: Dataset to be saved
+    :param encoding: Encoding the caller asked for
+    :param compression: Name of the compression filter
+    :return: Encoding to save the dataset with
+    """
+    encoding = dict(encoding)
+    if compression == 'zlib':
+        compression_encoding = {'zlib': True}
+    elif compression.startswith('blosc'):
+        # Blosc shuffles the bits of each chunk itself, so HDF5's byte shuffle is left off
+        compression_encoding = {'compression': compression, 'blosc_shuffle': 2}
+    else:
+        compression_encoding = {'compression': compression}
+    for key in dataset.keys():
+        encoding[key] = {**compression_encoding, **encoding.get(key, {})}
+        if 'chunksizes' not in encoding[key] and 'time' in dataset[key].dims and dataset[key].size > 0:
+            encoding[key]['chunksizes'] = get_chunksizes(dataset[key])
+        if compression.startswith('blosc'):
+            encoding[key]['shuffle'] = False
+    return encoding
+
+
+def save_to_zarr(dataset, path, encoding, compute=True):
+    """
+    Saves an xarray Dataset to a Zarr store, replacing any store already at that path. The store is chunked the same
+    way as the netCDF files, and so it can be written straight from the dask arrays in parallel.
+
+    :param dataset: Dataset to save
+    :param path: Path of the store
+    :param encoding: Encoding in the form used for netCDF. Chunk sizes and the settings in ZARR_ENCODING_KEYS are kept.
+    :param compute: If False, the store is only set up, and a dask Delayed object that writes the data is returned
+    """
+    encoding = encoding if encoding is not None else {}
+    chunks = {}
+    for key in dataset.keys():
+        if 'chunksizes' in encoding.get(key, {}):
+            chunks.update(zip(dataset[key].dims, encoding[key]['chunksizes']))
+        elif 'time' in dataset[key].dims and dataset[key].size > 0:
+            chunks.update(zip(dataset[key].dims, get_chunksizes(dataset[key])))
+    dataset = dataset.chunk(chunks)
+    zarr_encoding = {}
+    for key, settings in encoding.items():
+        zarr_encoding[key] = {name: value for name, value in settings.items() if name in ZARR_ENCODING_KEYS}
+    delayed_obj = dataset.to_zarr(path, mode='w', compute=False, encoding=zarr_encoding)
+    if not compute:
+        return delayed_obj
+    with get_progress_bar():
+        delayed_obj.compute()
+
+
+def get_packing_parameters(variable):
+    """
+    Chooses the scale_factor and add_offset that spread a variable's range over the 16 bit integers, leaving -32768
+    for the fill value. The precision is then the range divided by 65534.
+
+    :param variable: DataArray to be packed
+    :return: Tuple of (scale_factor, add_offset)
+    """
+    minimum, maximum = dask.compute(variable.min(), variable.max())
+    minimum, maximum = float(minimum), float(maximum)
+    if numpy.isnan(minimum) or minimum == maximum:
+        # Nothing or a single value to store, which any scale_factor holds exactly
+        return 1.0, (0.0 if numpy.isnan(minimum) else minimum)
+    return (maximum - minimum) / 65534, (maximum + minimum) / 2
+
+
+def get_progress_bar():
+    """
+    Gets a progress bar for a dask computation, which writes to the log instead of stdout. The progress is logged on
+    INFO, so if that level isn't logged, nothing is returned to track it with.
+
+    :return: Context manager to compute in
+    """
+    if LOGGER.isEnabledFor(logging.INFO):
+        return ProgressBar(out=LoggerWriter(LOGGER, logging.INFO), dt=1)
+    return contextlib.nullcontext()
+
+
+def get_chunksizes(variable):
+    """
+    Chooses netCDF chunk sizes for a variable with a time dimension: the whole extent of every other dimension, and as
+    many time steps as fit in TARGET_CHUNK_BYTES (at least one).
+
+    :param variable: DataArray to be saved
+    :return: Tuple of chunk sizes, in the order of the variable's dimensions
+    """
+    time_steps = variable.sizes['time']
+    step_bytes = variable.dtype.itemsize * (variable.size // time_steps)
+    time_chunk = max(1, min(time_steps, TARGET_CHUNK_BYTES // step_bytes))
+    return tuple(time_chunk if dim == 'time' else size for dim, size in variable.sizes.items())
@@ -2,6 +2,7 @@ import argparse
 import xarray
 from datetime import datetime
 import os
+import sys
 import utils
 import logging
 
@@ -21,20 +22,27 @@ def main():
     print('Starting time: ' + str(start_time))
 
     options = get_options()
-    dataset = xarray.open_dataset(options.input)
+    # Opened in the file's own chunks, so the transpose is lazy and the result is written a chunk at a time instead of
+    # loading the whole file
+    dataset = xarray.open_dataset(options.input, chunks={})
     result = transpose(dataset, options.dims)
 
     if options.output and not options.output == options.input:
-        utils.save_to_netcdf(result, options.output)
+        if not utils.save_to_netcdf(result, options.output, compression=options.compression):
+            sys.exit(1)
     else:
         # xarray uses lazy loading from disk so overwriting the input file isn't possible without forcing a full load
-        # into memory, which is infeasible with large datasets. Instead, save to a temp file, then remove the original
-        # and rename the temp file to the original. As a bonus, this is atomic.
+        # into memory, which is infeasible with large datasets. Instead, save to a temp file, then move it over the
+        # original. As a bonus, this is atomic, and the input path never goes missing in between.
         temp_filename = options.input + '_temp'
-        utils.save_to_netcdf(result, temp_filename)
+        saved = utils.save_to_netcdf(result, temp_filename, compression=options.compression)
         dataset.close()
-        os.remove(options.input)
-        os.rename(temp_filename, options.input)
+        # The input is only replaced by a complete file. save_to_netcdf() has already logged what went wrong.
+        if not saved:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            sys.exit(1)
+        os.replace(temp_filename, options.input)
 
     end_time = datetime.now()
     print('End time: ' + str(end_time))
@@ -48,7 +56,7 @@ def get_options():
     Options are accessed via options.input, options.output, etc.
 
     Required arguments: input, dims
-    Optional arguments: output
+    Optional arguments: output, compression
 
     Run this with the -h (help) argument for more detailed information. (python transpose.py -h)
 
@@ -70,11 +78,19 @@ def get_options():
         nargs='+',
         required=True
     )
+    parser.add_argument(
+        '--compression',
+        help='How to compress the result. zstd and blosc_zstd are much faster to write than zlib, but need netCDF4 '
+             '1.6+ and can only be read where the netCDF library has those filters.',
+        choices=['zlib', 'zstd', 'blosc_zstd'],
+        default='zlib'
+    )
     args = parser.parse_args()
     return args
 
 
 def transpose(dataset, dims):
+    # For dask arrays this only reorders the axes of each chunk, keeping the chunks as they were
     return dataset.transpose(*dims)
 
 
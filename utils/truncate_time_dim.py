@@ -1,8 +1,8 @@
 import argparse
 import xarray
-import numpy
 from datetime import datetime
 import os
+import sys
 import utils
 import logging
 
@@ -15,20 +15,26 @@ def main():
     LOGGER.info('Starting time: ' + str(start_time))
 
     options = get_options()
-    dataset = xarray.open_dataset(options.input)
+    # Opened in the file's own chunks, so the data is streamed through to the output instead of loaded whole
+    dataset = xarray.open_dataset(options.input, chunks={})
     result = truncate_time_dim(dataset)
 
     if options.output and options.output != options.input:
-        utils.save_to_netcdf(result, options.output)
+        if not utils.save_to_netcdf(result, options.output):
+            sys.exit(1)
     else:
         # xarray uses lazy loading from disk so overwriting the input file isn't possible without forcing a full load
-        # into memory, which is infeasible with large datasets. Instead, save to a temp file, then remove the original
-        # and rename the temp file to the original. As a bonus, this is atomic.
+        # into memory, which is infeasible with large datasets. Instead, save to a temp file, then move it over the
+        # original. As a bonus, this is atomic, and the input path never goes missing in between.
         temp_filename = options.input + '_temp'
-        utils.save_to_netcdf(result, temp_filename)
+        saved = utils.save_to_netcdf(result, temp_filename)
         dataset.close()
-        os.remove(options.input)
-        os.rename(temp_filename, options.input)
+        # The input is only replaced by a complete file. save_to_netcdf() has already logged what went wrong.
+        if not saved:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            sys.exit(1)
+        os.replace(temp_filename, options.input)
 
     end_time = datetime.now()
     LOGGER.info('End time: ' + str(end_time))
@@ -63,7 +69,8 @@ def get_options():
 
 
 def truncate_time_dim(dataset):
-    dataset = dataset.assign(time=numpy.array(dataset['time'].values, dtype='datetime64[M]'))
+    # Only the time coordinate is replaced, and the data variables are left as they are, including lazy ones
+    dataset = dataset.assign_coords(time=dataset['time'].values.astype('datetime64[M]'))
     return dataset
 
 